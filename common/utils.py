@@ -0,0 +1,170 @@
+# Copyright (c) 2006-2010  Shaun McCance  <shaunm@gnome.org>
+#
+# This file is part of Blip, a program for displaying various statistics
+# of questionable relevance about software and the people who make it.
+#
+# Blip is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blip is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blip; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+import os
+import shutil
+import tempfile
+
+try:
+    from hashlib import md5
+except:
+    from md5 import new as md5
+
+from storm.expr import And, Max, Select
+from storm.info import ClassAlias
+from storm.store import Store
+
+import blinq.config
+
+import blip.db
+import blip.parsers
+import blip.parsers.automake
+
+def store_output_file (of, filename):
+    """
+    Store a copy of a file as an OutputFile, if its contents changed.
+    """
+    outfile = of.get_file_path ()
+    content = open (filename).read ()
+    digest = md5 (content).hexdigest ()
+    olddigest = of.data.get ('filemd5')
+    if olddigest == digest and os.path.exists (outfile):
+        return False
+
+    blob = get_blob_path (digest)
+    blobdir = os.path.dirname (blob)
+    if not os.path.exists (blob):
+        if not os.path.exists (blobdir):
+            os.makedirs (blobdir)
+        fd, tmp = tempfile.mkstemp (dir=blobdir)
+        try:
+            os.write (fd, content)
+        finally:
+            os.close (fd)
+        os.chmod (tmp, 0644)
+        os.rename (tmp, blob)
+
+    oldblob = None
+    if olddigest is not None:
+        oldblob = get_blob_path (olddigest)
+    link_output_file (blob, outfile, oldblob)
+    of.data['filemd5'] = digest
+    return True
+
+def get_blob_path (name):
+    return os.path.join (blinq.config.web_files_dir, 'blobs', name[:2], name)
+
+def link_output_file (blob, outfile, oldblob=None):
+    """
+    Hard link an output file to a blob, or copy it if it can't be linked.
+    """
+    if (oldblob is None or oldblob == blob or not os.path.exists (outfile) or
+        not os.path.exists (oldblob) or not os.path.samefile (outfile, oldblob)):
+        oldblob = None
+    outdir = os.path.dirname (outfile)
+    if not os.path.exists (outdir):
+        os.makedirs (outdir)
+    tmp = os.path.join (outdir, '.' + os.path.basename (outfile) + '.tmp')
+    if os.path.exists (tmp):
+        os.remove (tmp)
+    try:
+        os.link (blob, tmp)
+    except OSError:
+        shutil.copyfile (blob, tmp)
+    os.rename (tmp, outfile)
+    if oldblob is not None:
+        remove_unlinked_blob (oldblob)
+
+def remove_unlinked_blob (blob):
+    """Remove a blob if no output file links to it."""
+    try:
+        if os.stat (blob).st_nlink == 1:
+            os.remove (blob)
+    except OSError:
+        pass
+
+class BuildFiles:
+    """
+    Parsed build files shared by every plugin scanning a branch.
+    """
+
+    branch = None
+    files = {}
+
+    @classmethod
+    def get (cls, parser, branch, filename):
+        """Get a parsed build file, parsing it if needed."""
+        if cls.branch != branch.ident:
+            cls.branch = branch.ident
+            cls.files = {}
+        stat = os.stat (filename)
+        key = (parser, filename)
+        entry = cls.files.get (key)
+        if entry is None or entry[0] != (stat.st_mtime, stat.st_size):
+            parsed = blip.parsers.get_parsed_file (parser, branch, filename)
+            includes = set()
+            if parser is blip.parsers.automake.Automake:
+                for line in parsed.get_lines ():
+                    if line.startswith ('include $(top_srcdir)/'):
+                        includes.add (os.path.basename (line.strip ()))
+            entry = ((stat.st_mtime, stat.st_size), parsed, includes)
+            cls.files[key] = entry
+        return entry[1]
+
+    @classmethod
+    def get_includes (cls, branch, filename):
+        """Get the base names of the files a Makefile.am includes from $(top_srcdir)."""
+        cls.get (blip.parsers.automake.Automake, branch, filename)
+        return cls.files[(blip.parsers.automake.Automake, filename)][2]
+
+def get_last_revisions (branch, groups):
+    """
+    Get the last revision on a branch for each of a list of file groups.
+    """
+    files = set ()
+    for group in groups:
+        files.update (group)
+    last = {}
+    if len(files) > 0:
+        RevisionFile = blip.db.RevisionFile
+        Revision = blip.db.Revision
+        OtherFile = ClassAlias (RevisionFile)
+        OtherRevision = ClassAlias (Revision)
+        newest = Select (Max (OtherRevision.datetime),
+                         where=And (OtherFile.filename == RevisionFile.filename,
+                                    OtherFile.revision_ident == OtherRevision.ident,
+                                    OtherRevision.branch_ident == branch.ident),
+                         tables=[OtherFile, OtherRevision])
+        rows = Store.of (branch).find ((RevisionFile.filename, Revision),
+                                       RevisionFile.filename.is_in (list (files)),
+                                       RevisionFile.revision_ident == Revision.ident,
+                                       Revision.branch_ident == branch.ident,
+                                       Revision.datetime == newest)
+        for filename, revision in rows:
+            last[filename] = revision
+    revisions = []
+    for group in groups:
+        revision = None
+        for filename in group:
+            rev = last.get (filename, None)
+            if rev is not None and (revision is None or rev.datetime > revision.datetime):
+                revision = rev
+        revisions.append (revision)
+    return revisions
@@ -29,6 +29,7 @@ import blip.parsers
 import blip.parsers.automake
 
 import blip.plugins.modules.sweep
+from blip.plugins.common.utils import BuildFiles, get_last_revisions
 
 class QuickRefScanner (blip.plugins.modules.sweep.ModuleFileScanner):
     def __init__ (self, scanner):
@@ -67,8 +68,8 @@ class QuickRefScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                 raise
 
             stamp.log ()
-            makefile = blip.parsers.get_parsed_file (blip.parsers.automake.Automake,
-                                                     self.scanner.branch, filename)
+            makefile = BuildFiles.get (blip.parsers.automake.Automake,
+                                       self.scanner.branch, filename)
 
             ident = u'/'.join(['/doc', bserver, bmodule, 'quickref', bbranch])
             document = blip.db.Branch.get_or_create (ident, u'Document')
@@ -113,19 +114,14 @@ class QuickRefScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                 if match:
                     self.document.name = blip.utils.utf8dec (match.group(1))
                     break
-        rev = blip.db.Revision.get_last_revision (branch=self.document.parent,
-                                                  files=[os.path.join (self.document.scm_dir,
-                                                                       self.document.scm_file)])
-        if rev is not None:
-            self.document.mod_datetime = rev.datetime
-            self.document.mod_person = rev.person
-        self.document.updated = datetime.datetime.utcnow ()
 
-        for translation in blip.db.Branch.select (type=u'Translation', parent=self.document):
-            rev = blip.db.Revision.get_last_revision (branch=self.document.parent,
-                                                      files=[os.path.join (translation.scm_dir,
-                                                                           translation.scm_file)])
+        records = [self.document]
+        records += list (blip.db.Branch.select (type=u'Translation', parent=self.document))
+        revs = get_last_revisions (self.document.parent,
+                                   [[os.path.join (record.scm_dir, record.scm_file)]
+                                    for record in records])
+        for record, rev in zip (records, revs):
             if rev is not None:
-                translation.mod_datetime = rev.datetime
-                translation.mod_person = rev.person
-            translation.updated = datetime.datetime.utcnow()
+                record.mod_datetime = rev.datetime
+                record.mod_person = rev.person
+            record.updated = datetime.datetime.utcnow ()
@@ -31,6 +31,7 @@ import blip.parsers
 import blip.parsers.autoconf
 
 import blip.plugins.modules.sweep
+from blip.plugins.common.utils import BuildFiles
 
 class KeyFileScanner (blip.plugins.modules.sweep.ModuleFileScanner):
     """
@@ -46,9 +47,9 @@ class KeyFileScanner (blip.plugins.modules.sweep.ModuleFileScanner):
     def process_file (self, dirname, basename):
         if dirname == self.scanner.repository.directory:
             if basename in ('configure.ac', 'configure.in'):
-                self._autoconf = blip.parsers.get_parsed_file (blip.parsers.autoconf.Autoconf,
-                                                               self.scanner.branch,
-                                                               os.path.join (dirname, basename))
+                self._autoconf = BuildFiles.get (blip.parsers.autoconf.Autoconf,
+                                                 self.scanner.branch,
+                                                 os.path.join (dirname, basename))
                 return
         if basename == 'common.desktop.in':
             self._commons[dirname] = basename
@@ -0,0 +1,259 @@
+# Copyright (c) 2010  Shaun McCance  <shaunm@gnome.org>
+#
+# This file is part of Blip, a program for displaying various statistics
+# of questionable relevance about software and the people who make it.
+#
+# Blip is free software; you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# Blip is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with Blip; if not, write to the Free Software Foundation, 59 Temple Place,
+# Suite 330, Boston, MA  0211-1307  USA.
+#
+
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from hashlib import md5
+except:
+    from md5 import new as md5
+
+import blip.utils
+
+from blip.plugins.common.utils import get_blob_path, link_output_file, remove_unlinked_blob
+
+class LinkGraph:
+    """
+    A directed graph of links between pages.
+    """
+
+    dot_header = ('strict digraph topics {\n'
+                  'width="3";\n'
+                  'rankdir="LR";\n'
+                  'splines="%s";\n'
+                  'node [shape=box,width=2,fontname=sans,fontsize=10];\n')
+
+    def __init__ (self, links=[]):
+        self._nodes = []
+        self._links = {}
+        self._linksets = {}
+        self._backlinks = {}
+        for src, dst in links:
+            self.add_link (src, dst)
+
+    def add_node (self, node):
+        if not self._links.has_key (node):
+            self._nodes.append (node)
+            self._links[node] = []
+            self._linksets[node] = set()
+            self._backlinks[node] = set()
+
+    def add_link (self, src, dst):
+        self.add_node (src)
+        self.add_node (dst)
+        if dst not in self._linksets[src]:
+            self._links[src].append (dst)
+            self._linksets[src].add (dst)
+        self._backlinks[dst].add (src)
+
+    def get_nodes (self):
+        return list (self._nodes)
+
+    def get_links (self, node):
+        """Get the nodes a node links to, in the order they were added."""
+        return list (self._links.get (node, []))
+
+    def get_backlinks (self, node):
+        """Get the set of nodes that link to a node."""
+        return self._backlinks.get (node, set())
+
+    def get_subgraph (self, node, max_nodes=40):
+        """
+        Get the neighbourhood of a node as a new graph.
+        """
+        nodes = [node]
+        seen = set ([node])
+        for other in sorted (self.get_backlinks (node)) + self.get_links (node):
+            if other not in seen:
+                nodes.append (other)
+                seen.add (other)
+        more = len(nodes) - max_nodes
+        if more > 0:
+            nodes = nodes[:max_nodes]
+        subgraph = LinkGraph ()
+        subgraph.add_node (node)
+        included = set(nodes)
+        for src in nodes:
+            for dst in self.get_links (src):
+                if dst in included:
+                    subgraph.add_link (src, dst)
+        if more > 0:
+            subgraph.add_link (node, '(%i more)' % more)
+        return subgraph
+
+    def get_dot (self, splines='ortho'):
+        lines = [self.dot_header % splines]
+        for src in sorted (self._links.keys ()):
+            for dst in sorted (self._links[src]):
+                lines.append ('"%s" -> "%s";\n' % (_dot_escape (src), _dot_escape (dst)))
+        lines.append ('}\n')
+        return ''.join (lines)
+
+    def get_hash (self):
+        return md5 (self.get_dot ()).hexdigest ()
+
+
+class GraphRenderer:
+    """
+    A queue of link graphs to render with Graphviz in the background.
+    """
+
+    max_workers = 2
+    timeout = 60
+    layouts = ['ortho', 'line']
+
+    lock = threading.Lock ()
+    pending = {}
+    queue = []
+    latest = {}
+    rendering = set()
+    workers = 0
+
+    @classmethod
+    def configure (cls, scanner):
+        cls.max_workers = max (1, int (scanner.request.get_tool_option ('graph_jobs', 2)))
+        cls.timeout = int (scanner.request.get_tool_option ('graph_timeout', 60))
+
+    @classmethod
+    def get_blob_path (cls, graphhash):
+        return get_blob_path (graphhash + '.svg')
+
+    @classmethod
+    def remove_blob (cls, graphhash):
+        """Remove the SVG for a graph if no output file links to it."""
+        remove_unlinked_blob (cls.get_blob_path (graphhash))
+
+    @classmethod
+    def render (cls, outfile, graph, oldhash=None):
+        """Render a LinkGraph to an SVG output file, possibly later."""
+        graphhash = graph.get_hash ()
+        oldblob = None
+        if oldhash is not None:
+            oldblob = cls.get_blob_path (oldhash)
+        with cls.lock:
+            if cls.pending.pop (outfile, None) is not None:
+                cls.queue.remove (outfile)
+            cls.latest[outfile] = graphhash
+            if os.path.exists (cls.get_blob_path (graphhash)):
+                link_output_file (cls.get_blob_path (graphhash), outfile, oldblob)
+                return
+            cls.pending[outfile] = (graphhash, graph, oldblob)
+            cls.queue.append (outfile)
+            if cls.workers < cls.max_workers:
+                cls.workers += 1
+                # Worker threads aren't daemons, so the sweep doesn't exit
+                # until every queued graph has been rendered.
+                threading.Thread (target=cls.run_worker).start ()
+
+    @classmethod
+    def render_now (cls, graph, timeout=None):
+        """
+        Render a LinkGraph right away, and get the path to its SVG.
+        """
+        graphhash = graph.get_hash ()
+        blob = cls.get_blob_path (graphhash)
+        if not os.path.exists (blob):
+            if timeout is None:
+                timeout = cls.timeout
+            cls.render_blob (graph, blob, deadline=time.time () + timeout)
+        if os.path.exists (blob):
+            return blob
+        return None
+
+    @classmethod
+    def run_worker (cls):
+        while True:
+            with cls.lock:
+                job = None
+                for outfile in cls.queue:
+                    # Requests for a graph that's being rendered are left
+                    # for the worker rendering it, which links them after.
+                    if cls.pending[outfile][0] not in cls.rendering:
+                        graphhash, graph, oldblob = cls.pending.pop (outfile)
+                        cls.queue.remove (outfile)
+                        cls.rendering.add (graphhash)
+                        job = (outfile, graphhash, graph, oldblob)
+                        break
+                if job is None:
+                    cls.workers -= 1
+                    return
+            outfile, graphhash, graph, oldblob = job
+            try:
+                blob = cls.get_blob_path (graphhash)
+                if not os.path.exists (blob):
+                    cls.render_blob (graph, blob)
+                with cls.lock:
+                    if os.path.exists (blob) and cls.latest.get (outfile) == graphhash:
+                        link_output_file (blob, outfile, oldblob)
+            except Exception, err:
+                blip.utils.warn ('Failed to render graph %s: %s' % (outfile, err))
+            finally:
+                with cls.lock:
+                    cls.rendering.discard (graphhash)
+
+    @classmethod
+    def render_blob (cls, graph, blob, deadline=None):
+        """
+        Render a LinkGraph to an SVG blob, trying each splines layout in turn.
+        """
+        blobdir = os.path.dirname (blob)
+        if not os.path.exists (blobdir):
+            os.makedirs (blobdir)
+        fd, tmp = tempfile.mkstemp (dir=blobdir)
+        os.close (fd)
+        try:
+            for i in range (len(cls.layouts)):
+                splines = cls.layouts[i]
+                timeout = cls.timeout
+                if deadline is not None:
+                    timeout = min (timeout, (deadline - time.time ()) / (len(cls.layouts) - i))
+                    if timeout <= 0:
+                        break
+                blip.utils.log ('Rendering graph %s with %s splines' % (os.path.basename (blob),
+                                                                       splines))
+                popen = subprocess.Popen (['dot', '-Tsvg', '-o', tmp], stdin=subprocess.PIPE)
+                timer = threading.Timer (timeout, _kill_process, (popen,))
+                timer.start ()
+                try:
+                    popen.communicate (graph.get_dot (splines))
+                finally:
+                    timer.cancel ()
+                if popen.returncode == 0:
+                    os.chmod (tmp, 0644)
+                    os.rename (tmp, blob)
+                    return
+                blip.utils.warn ('Graph %s failed or timed out with %s splines' %
+                                 (os.path.basename (blob), splines))
+        finally:
+            if os.path.exists (tmp):
+                os.remove (tmp)
+
+def _kill_process (popen):
+    try:
+        popen.kill ()
+    except OSError:
+        pass
+
+def _dot_escape (string):
+    return string.replace ('\\', '\\\\').replace ('"', '\\"')
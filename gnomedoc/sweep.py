@@ -20,9 +20,10 @@
 
 import commands
 import ConfigParser
+import cStringIO
 import datetime
+import multiprocessing
 import re
-import subprocess
 import os
 import urllib
 
@@ -44,8 +45,11 @@ import blip.parsers.automake
 import blip.parsers.po
 
 import blip.plugins.modules.sweep
+from blip.plugins.common.utils import BuildFiles, get_last_revisions
+from blip.plugins.gnomedoc.graphs import LinkGraph, GraphRenderer
 
 MALLARD_NS = 'http://projectmallard.org/1.0/'
+XINCLUDE_NS = 'http://www.w3.org/2001/XInclude'
 
 _STATUSES = {'none':       '00',
              'stub':       '10',
@@ -62,6 +66,151 @@ def get_status (status):
         return '00none'
 
 
+class XmlCatalog:
+    """
+    A process-wide cache of DTDs and entity files for libxml2.
+    """
+
+    installed = False
+    catalog_dir = None
+    resources = {}
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def install (cls, scanner):
+        if cls.installed:
+            return
+        cls.installed = True
+        cls.catalog_dir = scanner.request.get_tool_option ('xml_catalog_dir', None)
+        if cls.catalog_dir is not None:
+            catalog = os.path.join (cls.catalog_dir, 'catalog')
+            if os.path.isfile (catalog):
+                libxml2.loadCatalog (catalog)
+        libxml2.setEntityLoader (cls.load_entity)
+
+    @classmethod
+    def log_stats (cls):
+        blip.utils.log ('Reused DTDs and entities %i times, loaded %i' %
+                        (cls.hits, cls.misses))
+
+    @classmethod
+    def load_entity (cls, url, pubid, ctxt):
+        if url is None:
+            return None
+        remote = url.find ('://') > 0 and not url.startswith ('file:')
+        if not (remote or pubid is not None or os.path.splitext (url)[1] in ('.dtd', '.ent', '.mod')):
+            return None
+        key = (pubid, url)
+        if cls.resources.has_key (key):
+            cls.hits += 1
+            return cStringIO.StringIO (cls.resources[key])
+        filename = cls.find_entity (url, pubid)
+        if filename is None:
+            return None
+        try:
+            content = open (filename).read ()
+        except IOError:
+            return None
+        cls.misses += 1
+        cls.resources[key] = content
+        return cStringIO.StringIO (content)
+
+    @classmethod
+    def find_entity (cls, url, pubid):
+        """Find a local file for a DTD or entity, or None."""
+        resolved = libxml2.catalogResolve (pubid, url)
+        for path in (resolved, url):
+            if path is None:
+                continue
+            if path.startswith ('file://'):
+                path = path[7:]
+            if path.find ('://') < 0 and os.path.isfile (path):
+                return path
+        if cls.catalog_dir is None:
+            return None
+        path = url
+        if path.find ('://') > 0:
+            path = path[path.find ('://') + 3:]
+        parts = [part for part in path.split ('/') if part not in ('', '.', '..')]
+        for i in range (len(parts)):
+            filename = os.path.join (cls.catalog_dir, *parts[i:])
+            if os.path.isfile (filename):
+                return filename
+        return None
+
+
+
+class EntityResolver:
+    """
+    Entities for document credits, remembered for the whole sweep.
+    """
+
+    emails = {}
+    ghosts = {}
+    extended = set()
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def get_ghost_ident (cls, cr_name):
+        return u'/ghost/' + urllib.quote (cr_name)
+
+    @classmethod
+    def prefetch (cls, credits):
+        """Look up the entities for a list of (name, email) pairs in bulk."""
+        emails = set()
+        idents = {}
+        for cr_name, cr_email in credits:
+            if cr_email is not None:
+                if not cls.emails.has_key (cr_email):
+                    emails.add (cr_email)
+            elif cr_name is not None:
+                cr_name = normalize (cr_name)
+                if not cls.ghosts.has_key (cr_name):
+                    idents[cls.get_ghost_ident (cr_name)] = cr_name
+        if len(emails) > 0:
+            for ent in blip.db.Entity.select (blip.db.Entity.email.is_in (list (emails))):
+                cls.emails[ent.email] = ent
+        if len(idents) > 0:
+            for ent in blip.db.Entity.select (blip.db.Entity.ident.is_in (idents.keys ())):
+                cls.ghosts[idents[ent.ident]] = ent
+
+    @classmethod
+    def resolve (cls, cr_name, cr_email):
+        """Get the entity for a credit, or None."""
+        ent = None
+        if cr_email is not None:
+            if cls.emails.has_key (cr_email):
+                cls.hits += 1
+            else:
+                cls.misses += 1
+                cls.emails[cr_email] = blip.db.Entity.get_or_create_email (cr_email)
+            ent = cls.emails[cr_email]
+        if ent is None and cr_name is not None:
+            key = normalize (cr_name)
+            if cls.ghosts.has_key (key):
+                cls.hits += 1
+            else:
+                cls.misses += 1
+                ident = cls.get_ghost_ident (key)
+                ghost = blip.db.Entity.get_or_create (ident, u'Ghost')
+                if ghost.ident == ident:
+                    ghost.name = blip.utils.utf8dec (key)
+                cls.ghosts[key] = ghost
+            ent = cls.ghosts[key]
+        if ent is not None and (ent.ident, cr_name, cr_email) not in cls.extended:
+            ent.extend (name=blip.utils.utf8dec (cr_name))
+            ent.extend (email=blip.utils.utf8dec (cr_email))
+            cls.extended.add ((ent.ident, cr_name, cr_email))
+        return ent
+
+    @classmethod
+    def log_stats (cls):
+        blip.utils.log ('Resolved credits with %i hits and %i misses' %
+                        (cls.hits, cls.misses))
+
+
 class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
     def __init__ (self, scanner):
         self.documents = []
@@ -94,16 +243,10 @@ class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                         self.translations.append (translation)
                 raise
 
-            makefile = blip.parsers.get_parsed_file (blip.parsers.automake.Automake,
-                                                     self.scanner.branch, filename)
-
-            is_gdu_doc = False
-            for line in makefile.get_lines ():
-                if line.startswith ('include $(top_srcdir)/'):
-                    if line.endswith ('gnome-doc-utils.make'):
-                        is_gdu_doc = True
-                        break
-            if not is_gdu_doc:
+            makefile = BuildFiles.get (blip.parsers.automake.Automake,
+                                       self.scanner.branch, filename)
+            includes = BuildFiles.get_includes (self.scanner.branch, filename)
+            if 'gnome-doc-utils.make' not in includes:
                 return
 
             stamp.log ()
@@ -178,23 +321,25 @@ class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                     GnomeDocScanner.process_docbook (document, self.scanner)
                 elif document.subtype == u'gdu-mallard':
                     GnomeDocScanner.process_mallard (document, self.scanner)
-            rev = blip.db.Revision.get_last_revision (branch=document.parent,
-                                                      files=[os.path.join (document.scm_dir, fname)
-                                                             for fname in document.data.get ('scm_files', [])])
-            if rev is not None:
-                document.mod_datetime = rev.datetime
-                document.mod_person = rev.person
-            document.updated = datetime.datetime.utcnow ()
         for translation in self.translations:
             if translation.subtype == u'xml2po':
                 GnomeDocScanner.process_xml2po (translation, self.scanner)
-            rev = blip.db.Revision.get_last_revision (branch=document.parent,
-                                                      files=[os.path.join (translation.scm_dir,
-                                                                           translation.scm_file)])
+
+        groups = []
+        for document in self.documents:
+            groups.append ([os.path.join (document.scm_dir, fname)
+                            for fname in document.data.get ('scm_files', [])])
+        for translation in self.translations:
+            groups.append ([os.path.join (translation.scm_dir, translation.scm_file)])
+        XmlCatalog.log_stats ()
+        EntityResolver.log_stats ()
+
+        revs = get_last_revisions (self.scanner.branch, groups)
+        for record, rev in zip (self.documents + self.translations, revs):
             if rev is not None:
-                translation.mod_datetime = rev.datetime
-                translation.mod_person = rev.person
-            translation.updated = datetime.datetime.utcnow()
+                record.mod_datetime = rev.datetime
+                record.mod_person = rev.person
+            record.updated = datetime.datetime.utcnow ()
 
     @classmethod
     def process_docbook (cls, document, scanner):
@@ -202,75 +347,71 @@ class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                                  document.scm_dir, document.scm_file)
         rel_scm = blip.utils.relative_path (filename, blinq.config.scm_dir)
         blip.utils.log ('Processing %s' % rel_scm)
+        XmlCatalog.install (scanner)
 
         title = None
         abstract = None
         credits = []
         process = False
+        streaming = not scanner.request.get_tool_option ('docbook_dom', False)
         with blip.db.Error.catch (document):
-            ctxt = libxml2.newParserCtxt ()
-            xmldoc = ctxt.ctxtReadFile (filename, None,
-                                        libxml2.XML_PARSE_DTDLOAD | libxml2.XML_PARSE_NOCDATA |
-                                        libxml2.XML_PARSE_NOENT | libxml2.XML_PARSE_NONET)
-            xmldoc.xincludeProcess ()
-            root = xmldoc.getRootElement ()
+            seen = 0
+            document.data['status'] = '00none'
+            # Nodes are only valid until the next one is read, so everything
+            # is pulled out of them inside the loop.
+            for node in docbook_info_nodes (filename, streaming=streaming):
+                if node.name[-4:] == 'info':
+                    seen += 1
+                    infonodes = list (xmliter (node))
+                    i = 0
+                    while i < len(infonodes):
+                        infonode = infonodes[i]
+                        if infonode.type != 'element':
+                            i += 1
+                            continue
+                        if infonode.name == 'title':
+                            if title is None:
+                                title = infonode.getContent ()
+                        elif infonode.name == 'abstract' and infonode.prop('role') == 'description':
+                            abstract = infonode.getContent ()
+                        elif infonode.name == 'releaseinfo':
+                            if infonode.prop ('revision') == document.parent.data.get ('pkgseries'):
+                                document.data['docstatus'] = get_status (infonode.prop ('role'))
+                        elif infonode.name == 'authorgroup':
+                            infonodes.extend (list (xmliter (infonode)))
+                        elif infonode.name in ('author', 'editor', 'othercredit'):
+                            cr_name, cr_email = personname (infonode)
+                            maint = (infonode.prop ('role') == 'maintainer')
+                            credits.append ((cr_name, cr_email, infonode.name, maint))
+                        elif infonode.name == 'collab':
+                            cr_name = None
+                            for ch in xmliter (infonode):
+                                if ch.type == 'element' and ch.name == 'collabname':
+                                    cr_name = normalize (ch.getContent ())
+                            if cr_name is not None:
+                                maint = (infonode.prop ('role') == 'maintainer')
+                                credits.append ((cr_name, None, 'collab', maint))
+                        elif infonode.name in ('corpauthor', 'corpcredit'):
+                            maint = (infonode.prop ('role') == 'maintainer')
+                            credits.append ((normalize (infonode.getContent ()),
+                                                  None, infonode.name, maint))
+                        elif infonode.name == 'publisher':
+                            cr_name = None
+                            for ch in xmliter (infonode):
+                                if ch.type == 'element' and ch.name == 'publishername':
+                                    cr_name = normalize (ch.getContent ())
+                            if cr_name is not None:
+                                maint = (infonode.prop ('role') == 'maintainer')
+                                credits.append ((cr_name, None, 'publisher', maint))
+                        i += 1
+                elif node.name == 'title':
+                    seen += 1
+                    title = node.getContent ()
+                if seen > 1:
+                    break
             process = True
         if not process:
             return
-        seen = 0
-        document.data['status'] = '00none'
-        for node in xmliter (root):
-            if node.type != 'element':
-                continue
-            if node.name[-4:] == 'info':
-                seen += 1
-                infonodes = list (xmliter (node))
-                i = 0
-                while i < len(infonodes):
-                    infonode = infonodes[i]
-                    if infonode.type != 'element':
-                        i += 1
-                        continue
-                    if infonode.name == 'title':
-                        if title is None:
-                            title = infonode.getContent ()
-                    elif infonode.name == 'abstract' and infonode.prop('role') == 'description':
-                        abstract = infonode.getContent ()
-                    elif infonode.name == 'releaseinfo':
-                        if infonode.prop ('revision') == document.parent.data.get ('pkgseries'):
-                            document.data['docstatus'] = get_status (infonode.prop ('role'))
-                    elif infonode.name == 'authorgroup':
-                        infonodes.extend (list (xmliter (infonode)))
-                    elif infonode.name in ('author', 'editor', 'othercredit'):
-                        cr_name, cr_email = personname (infonode)
-                        maint = (infonode.prop ('role') == 'maintainer')
-                        credits.append ((cr_name, cr_email, infonode.name, maint))
-                    elif infonode.name == 'collab':
-                        cr_name = None
-                        for ch in xmliter (infonode):
-                            if ch.type == 'element' and ch.name == 'collabname':
-                                cr_name = normalize (ch.getContent ())
-                        if cr_name is not None:
-                            maint = (infonode.prop ('role') == 'maintainer')
-                            credits.append ((cr_name, None, 'collab', maint))
-                    elif infonode.name in ('corpauthor', 'corpcredit'):
-                        maint = (infonode.prop ('role') == 'maintainer')
-                        credits.append ((normalize (infonode.getContent ()),
-                                              None, infonode.name, maint))
-                    elif infonode.name == 'publisher':
-                        cr_name = None
-                        for ch in xmliter (infonode):
-                            if ch.type == 'element' and ch.name == 'publishername':
-                                cr_name = normalize (ch.getContent ())
-                        if cr_name is not None:
-                            maint = (infonode.prop ('role') == 'maintainer')
-                            credits.append ((cr_name, None, 'publisher', maint))
-                    i += 1
-            elif node.name == 'title':
-                seen += 1
-                title = node.getContent ()
-            if seen > 1:
-                break
 
         if title is not None:
             document.name = unicode (normalize (title))
@@ -278,18 +419,10 @@ class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
             document.desc = unicode (normalize (abstract))
 
         rels = []
+        EntityResolver.prefetch ([credit[:2] for credit in credits])
         for cr_name, cr_email, cr_type, cr_maint in credits:
-            ent = None
-            if cr_email is not None:
-                ent = blip.db.Entity.get_or_create_email (cr_email)
-            if ent is None:
-                ident = u'/ghost/' + urllib.quote (cr_name)
-                ent = blip.db.Entity.get_or_create (ident, u'Ghost')
-                if ent.ident == ident:
-                    ent.name = blip.utils.utf8dec (cr_name)
+            ent = EntityResolver.resolve (cr_name, cr_email)
             if ent is not None:
-                ent.extend (name=blip.utils.utf8dec (cr_name))
-                ent.extend (email=blip.utils.utf8dec (cr_email))
                 rel = blip.db.DocumentEntity.set_related (document, ent)
                 rel.author = (cr_type in ('author', 'corpauthor'))
                 rel.editor = (cr_type == 'editor')
@@ -300,160 +433,211 @@ class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
 
     @classmethod
     def process_mallard (cls, document, scanner):
+        XmlCatalog.install (scanner)
         cache = blip.db.CacheData.get ((document.ident, u'mallard-pages'))
         if cache is None:
             cache = blip.db.CacheData (ident=document.ident,
                                        key=u'mallard-pages')
 
-        for basename in document.data.get ('scm_files', []):
+        # Page entries are keyed by file name, and each one has an MD5 sum
+        # of the page and the files it XIncludes.  Only pages whose sums
+        # have changed are parsed.  The credit and link rollups for the
+        # document are kept in the cache too, under keys starting with a
+        # slash, and are updated from the old and new entries of each page.
+        if cache.data.get ('/format') != 2:
+            for key in cache.data.keys ():
+                del cache.data[key]
+            cache.data['/format'] = 2
+            cache.data['/credits'] = {}
+            cache.data['/links'] = {}
+
+        basenames = document.data.get ('scm_files', [])
+        timestamps = scanner.request.get_tool_option ('timestamps')
+        changed = False
+        for basename in cache.data.keys ():
+            if not basename.startswith ('/') and basename not in basenames:
+                cls.update_mallard_rollups (cache, basename, None)
+                del cache.data[basename]
+                changed = True
+
+        jobs = []
+        for basename in basenames:
             filename = os.path.join (scanner.repository.directory,
                                      document.scm_dir, basename)
             with blip.db.Error.catch (document, ctxt=basename):
-                with blip.db.Timestamp.stamped (filename, scanner.repository) as stamp:
-                    stamp.check (scanner.request.get_tool_option ('timestamps'))
-                    stamp.log ()
-                    cls.process_mallard_page (document, filename, cache, scanner)
-
-        doccredits = {}
-        topiclinks = {}
-        for pageid in cache.data.keys():
-            if pageid.startswith('/'):
-                continue
-            for cr_name, cr_email, cr_types in cache.data[pageid].get('credits', []):
-                doccredits.setdefault (cr_email, {})
-                doccredits[cr_email].setdefault ('name', cr_name)
-                for badge in ('maintainer', 'author','editor', 'publisher'):
-                    doccredits[cr_email].setdefault (badge, False)
-                    if badge in cr_types:
-                        doccredits[cr_email][badge] = True
-            topiclinks.setdefault (pageid, [])
-            for xref in cache.data[pageid]['topiclinks']:
-                if xref not in topiclinks[pageid]:
-                    topiclinks[pageid].append (xref)
-            for xref in cache.data[pageid]['guidelinks']:
-                topiclinks.setdefault (xref, [])
-                if pageid not in topiclinks[xref]:
-                    topiclinks[xref].append (pageid)
+                entry = cache.data.get (basename)
+                if entry is not None and not timestamps:
+                    if entry['hash'] == get_mallard_page_hash (filename, entry['deps']):
+                        continue
+                blip.utils.log ('Processing %s' %
+                                blip.utils.relative_path (filename, blinq.config.scm_dir))
+                jobs.append ((basename, filename))
+
+        # Pages are parsed independently, so with the mallard_jobs option
+        # they're parsed in a pool of worker processes.  The results are
+        # merged here in the same order as a serial run.
+        pkgseries = document.parent.data.get ('pkgseries', None)
+        numjobs = int (scanner.request.get_tool_option ('mallard_jobs', 1))
+        args = [(filename, pkgseries) for basename, filename in jobs]
+        if numjobs > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool (min (numjobs, len(jobs)))
+            try:
+                results = pool.map (_parse_mallard_page_job, args)
+            finally:
+                pool.close ()
+                pool.join ()
+            for info, err, hits, misses in results:
+                XmlCatalog.hits += hits
+                XmlCatalog.misses += misses
+        else:
+            results = map (_parse_mallard_page_job, args)
+        EntityResolver.prefetch ([credit[:2] for result in results if result[0] is not None
+                                  for credit in result[0]['credits']])
+        for i in range (len(jobs)):
+            basename, filename = jobs[i]
+            with blip.db.Error.catch (document, ctxt=basename):
+                info, err = results[i][:2]
+                if err is not None:
+                    raise err
+                deps = []
+                if info is not None:
+                    deps = info.pop ('deps')
+                entry = {'hash': get_mallard_page_hash (filename, deps),
+                         'deps': deps, 'info': info}
+                cls.update_mallard_rollups (cache, basename, entry)
+                cache.data[basename] = entry
+                cls.process_mallard_page (document, filename, info)
+                changed = True
+
+        # A graph that failed to render last time is retried even if no
+        # page changed.
+        if not changed:
+            cls.render_mallard_graph (document, scanner, cache)
+            return
+
+        pageidents = set()
+        for basename in basenames:
+            entry = cache.data.get (basename)
+            if entry is not None and entry['info'] is not None and entry['info']['id'] is not None:
+                pageidents.add (u'/page/' + entry['info']['id'] + document.ident)
+        document.set_children (u'DocumentPage',
+                               [page for page in document.select_children (u'DocumentPage')
+                                if page.ident in pageidents])
+
+        credits = []
+        for key in cache.data['/credits'].keys ():
+            cr_email = key[0]
+            cr_name = None
+            badges = set()
+            for basename in sorted (cache.data['/credits'][key].keys ()):
+                name, types = cache.data['/credits'][key][basename]
+                if cr_name is None:
+                    cr_name = name
+                badges.update (types)
+            credits.append ((cr_name, cr_email, badges))
+        EntityResolver.prefetch ([credit[:2] for credit in credits])
         rels = []
-        for cr_email in doccredits.keys():
-            ent = None
-            if cr_email is not None:
-                ent = blip.db.Entity.get_or_create_email (cr_email)
-            if ent is None:
-                ident = u'/ghost/' + urllib.quote (cr_name)
-                ent = blip.db.Entity.get_or_create (ident, u'Ghost')
+        for cr_name, cr_email, badges in credits:
+            ent = EntityResolver.resolve (cr_name, cr_email)
             if ent is not None:
                 rel = blip.db.DocumentEntity.set_related (document, ent)
-                for badge in ('maintainer', 'author', 'editor', 'pulisher'):
-                    setattr (rel, badge, badge in cr_types)
+                for badge in ('maintainer', 'author', 'editor', 'publisher'):
+                    setattr (rel, badge, badge in badges)
                 rels.append (rel)
         document.set_relations (blip.db.DocumentEntity, rels)
-        dot = ''
-        for pageid in sorted (topiclinks.keys()):
-            for xref in sorted (topiclinks[pageid]):
-                dot += ('"%s" -> "%s";\n' % (pageid, xref))
-        if dot != cache.data.get('/dot', ''):
+
+        graph = cls.render_mallard_graph (document, scanner, cache)
+        cache.data.pop ('/dot', None)
+
+        # Guides are pages with links to topics.  The Graph tab shows a
+        # subgraph around each one, rendered when it's first requested.
+        titles = {}
+        for basename in basenames:
+            entry = cache.data.get (basename)
+            if entry is not None and entry['info'] is not None:
+                titles[entry['info']['id']] = entry['info']['title']
+        cache.data['/guides'] = [(pageid, titles.get (pageid))
+                                 for pageid in sorted (graph.get_nodes ())
+                                 if len(graph.get_links (pageid)) > 0]
+
+    @classmethod
+    def render_mallard_graph (cls, document, scanner, cache):
+        """Queue the topic link graph for rendering if it isn't rendered, and return it."""
+        graph = LinkGraph (cache.data['/links'].keys ())
+        graphhash = graph.get_hash ()
+        # The graph is rendered in the background, so it's checked for again
+        # here in case rendering failed or was cut short last time.
+        if (graphhash != cache.data.get ('/graphhash') or
+            not os.path.exists (GraphRenderer.get_blob_path (graphhash))):
             of = blip.db.OutputFile.select_one (type=u'graphs', ident=document.ident, filename=u'topiclinks.svg')
             if of is None:
                 of = blip.db.OutputFile (type=u'graphs', ident=document.ident,
                                          filename=u'topiclinks.svg',
                                          datetime=datetime.datetime.now())
-            of.makedirs ()
-            outfile = of.get_file_path ()
-            outfile_rel = blip.utils.relative_path (outfile,
-                                                    os.path.join (blinq.config.web_files_dir, 'graphs'))
-            blip.utils.log ('Creating link graph %s' % outfile_rel)
-            fulldot = ('strict digraph topics {\n' +
-                       'width="3";\n' +
-                       'rankdir="LR";\n' +
-                       'splines="ortho";\n' +
-                       'node [shape=box,width=2,fontname=sans,fontsize=10];\n' +
-                       dot + '}\n')
-            popen = subprocess.Popen (['dot', '-Tsvg', '-o', outfile], stdin=subprocess.PIPE)
-            popen.communicate (fulldot)
+            else:
+                of.datetime = datetime.datetime.now ()
+            oldhash = of.data.get ('graphhash', None)
+            of.data['graphhash'] = graphhash
+            GraphRenderer.configure (scanner)
+            GraphRenderer.render (of.get_file_path (), graph, oldhash)
+            cache.data['/graphhash'] = graphhash
+        # Guide graphs are rendered by the web tab on request and aren't
+        # linked to output files, so the ones for the old graph are removed
+        # here when the graph changes.
+        guidehashes = cache.data.get ('/guidehashes', None)
+        if guidehashes is None or graphhash != cache.data.get ('/guidegraphhash'):
+            newhashes = [graph.get_subgraph (node).get_hash ()
+                         for node in sorted (graph.get_nodes ())
+                         if len(graph.get_links (node)) > 0]
+            for guidehash in guidehashes or []:
+                if guidehash not in newhashes:
+                    GraphRenderer.remove_blob (guidehash)
+            cache.data['/guidehashes'] = newhashes
+            cache.data['/guidegraphhash'] = graphhash
+        return graph
+
+    @classmethod
+    def update_mallard_rollups (cls, cache, basename, entry):
+        """
+        Update the document-level credits and links for a changed page.
+        """
+        credits = cache.data['/credits']
+        links = cache.data['/links']
+        old = cache.data.get (basename)
+        if old is not None and old['info'] is not None:
+            for cr_name, cr_email, cr_types in old['info']['credits']:
+                key = (cr_email, cr_name if cr_email is None else None)
+                if credits.has_key (key):
+                    credits[key].pop (basename, None)
+                    if len(credits[key]) == 0:
+                        del credits[key]
+            for link in get_mallard_page_links (old['info']):
+                links[link] -= 1
+                if links[link] <= 0:
+                    del links[link]
+        if entry is not None and entry['info'] is not None:
+            for cr_name, cr_email, cr_types in entry['info']['credits']:
+                key = (cr_email, cr_name if cr_email is None else None)
+                credits.setdefault (key, {})
+                if not credits[key].has_key (basename):
+                    credits[key][basename] = (cr_name, list (cr_types))
+                else:
+                    credits[key][basename][1].extend (cr_types)
+            for link in get_mallard_page_links (entry['info']):
+                links[link] = links.get (link, 0) + 1
 
 
     @classmethod
-    def process_mallard_page (cls, document, filename, cache, scanner):
-        title = None
-        desc = None
-        ctxt = libxml2.newParserCtxt ()
-        xmldoc = ctxt.ctxtReadFile (filename, None,
-                                    libxml2.XML_PARSE_DTDLOAD | libxml2.XML_PARSE_NOCDATA |
-                                    libxml2.XML_PARSE_NOENT | libxml2.XML_PARSE_NONET)
-        xmldoc.xincludeProcess ()
-        root = xmldoc.getRootElement ()
-        if not _is_ns_name (root, MALLARD_NS, 'page'):
+    def process_mallard_page (cls, document, filename, info):
+        """
+        Update the DocumentPage record for a parsed page.
+        """
+        if info is None:
             return
-        pageid = root.prop ('id')
-        cache.data.setdefault (pageid, {})
-        cache.data[pageid]['topiclinks'] = []
-        cache.data[pageid]['guidelinks'] = []
-        pkgseries = document.parent.data.get ('pkgseries', None)
-        revision = {}
-        def process_link_node (linknode):
-            linktype = linknode.prop ('type')
-            if linktype not in ('topic', 'guide'):
-                return
-            xref = linknode.prop ('xref')
-            xrefhash = xref.find ('#')
-            if xrefhash >= 0:
-                xref = xref[:xrefhash]
-            if xref != '':
-                lst = cache.data[pageid][linktype + 'links']
-                if xref not in lst:
-                    lst.append (xref)
-        for node in xmliter (root):
-            if node.type != 'element':
-                continue
-            if _is_ns_name (node, MALLARD_NS, 'info'):
-                for infonode in xmliter (node):
-                    if infonode.type != 'element':
-                        continue
-                    if _is_ns_name (infonode, MALLARD_NS, 'title'):
-                        if infonode.prop ('type') == 'text':
-                            title = normalize (infonode.getContent ())
-                    elif _is_ns_name (infonode, MALLARD_NS, 'desc'):
-                        desc = normalize (infonode.getContent ())
-                    elif _is_ns_name (infonode, MALLARD_NS, 'revision'):
-                        if pkgseries is not None:
-                            for prop in ('version', 'docversion', 'pkgversion'):
-                                if infonode.prop (prop) == pkgseries:
-                                    revdate = infonode.prop ('date')
-                                    revstatus = infonode.prop ('status')
-                                    if (not revision.has_key (prop)) or (revdate > revision[prop][0]):
-                                        revision[prop] = (revdate, revstatus)
-                    elif _is_ns_name (infonode, MALLARD_NS, 'credit'):
-                        types = infonode.prop ('type')
-                        if isinstance (types, basestring):
-                            types = types.split ()
-                        else:
-                            types = []
-                        crname = cremail = None
-                        for crnode in xmliter (infonode):
-                            if _is_ns_name (crnode, MALLARD_NS, 'name'):
-                                crname = normalize (crnode.getContent ())
-                            elif _is_ns_name (crnode, MALLARD_NS, 'email'):
-                                cremail = normalize (crnode.getContent ())
-                        if crname is not None or cremail is not None:
-                            cache.data[pageid].setdefault ('credits', [])
-                            cache.data[pageid]['credits'].append (
-                                (crname, cremail, types))
-                    elif _is_ns_name (infonode, MALLARD_NS, 'link'):
-                        process_link_node (infonode)
-            elif _is_ns_name (node, MALLARD_NS, 'title'):
-                if title is None:
-                    title = normalize (node.getContent ())
-            elif _is_ns_name (node, MALLARD_NS, 'section'):
-                for child in xmliter (node):
-                    if child.type != 'element':
-                        continue
-                    if _is_ns_name (child, MALLARD_NS, 'info'):
-                        for infonode in xmliter (child):
-                            if infonode.type != 'element':
-                                continue
-                            if _is_ns_name (infonode, MALLARD_NS, 'link'):
-                                process_link_node (infonode)
+        pageid = info['id']
+        title = info['title']
+        desc = info['desc']
+        revision = info['revision']
 
         docstatus = None
         docdate = None
@@ -475,20 +659,11 @@ class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                     page.data['docstatus'] = docstatus
                     page.data['docdate'] = docdate
             rels = []
-            for cr_name, cr_email, cr_types in cache.data[pageid].get('credits', []):
-                ent = None
-                if cr_email is not None:
-                    ent = blip.db.Entity.get_or_create_email (cr_email)
-                if ent is None:
-                    ident = u'/ghost/' + urllib.quote (cr_name)
-                    ent = blip.db.Entity.get_or_create (ident, u'Ghost')
-                    if ent.ident == ident:
-                        ent.name = blip.utils.utf8dec (cr_name)
+            for cr_name, cr_email, cr_types in info['credits']:
+                ent = EntityResolver.resolve (cr_name, cr_email)
                 if ent is not None:
-                    ent.extend (name=blip.utils.utf8dec (cr_name))
-                    ent.extend (email=blip.utils.utf8dec (cr_email))
                     rel = blip.db.DocumentEntity.set_related (page, ent)
-                    for badge in ('maintainer', 'author', 'editor', 'pulisher'):
+                    for badge in ('maintainer', 'author', 'editor', 'publisher'):
                         setattr (rel, badge, badge in cr_types)
                     rels.append (rel)
             page.set_relations (blip.db.DocumentEntity, rels)
@@ -616,6 +791,192 @@ class GnomeDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
             cls.potfiles[indir] = None
             return None
 
+def parse_mallard_page (filename, pkgseries):
+    """
+    Get the metadata of a Mallard page as plain data.
+    """
+    title = None
+    desc = None
+    ctxt = libxml2.newParserCtxt ()
+    xmldoc = ctxt.ctxtReadFile (filename, None,
+                                libxml2.XML_PARSE_DTDLOAD | libxml2.XML_PARSE_NOCDATA |
+                                libxml2.XML_PARSE_NOENT | libxml2.XML_PARSE_NONET)
+    root = xmldoc.getRootElement ()
+    if not _is_ns_name (root, MALLARD_NS, 'page'):
+        return None
+    deps = get_xinclude_deps (filename, root)
+    xmldoc.xincludeProcess ()
+    root = xmldoc.getRootElement ()
+    pageid = root.prop ('id')
+    links = {'topic': [], 'guide': []}
+    credits = []
+    revision = {}
+    def process_link_node (linknode):
+        linktype = linknode.prop ('type')
+        if linktype not in ('topic', 'guide'):
+            return
+        xref = linknode.prop ('xref')
+        xrefhash = xref.find ('#')
+        if xrefhash >= 0:
+            xref = xref[:xrefhash]
+        if xref != '' and xref not in links[linktype]:
+            links[linktype].append (xref)
+    for node in xmliter (root):
+        if node.type != 'element':
+            continue
+        if _is_ns_name (node, MALLARD_NS, 'info'):
+            for infonode in xmliter (node):
+                if infonode.type != 'element':
+                    continue
+                if _is_ns_name (infonode, MALLARD_NS, 'title'):
+                    if infonode.prop ('type') == 'text':
+                        title = normalize (infonode.getContent ())
+                elif _is_ns_name (infonode, MALLARD_NS, 'desc'):
+                    desc = normalize (infonode.getContent ())
+                elif _is_ns_name (infonode, MALLARD_NS, 'revision'):
+                    if pkgseries is not None:
+                        for prop in ('version', 'docversion', 'pkgversion'):
+                            if infonode.prop (prop) == pkgseries:
+                                revdate = infonode.prop ('date')
+                                revstatus = infonode.prop ('status')
+                                if (not revision.has_key (prop)) or (revdate > revision[prop][0]):
+                                    revision[prop] = (revdate, revstatus)
+                elif _is_ns_name (infonode, MALLARD_NS, 'credit'):
+                    types = infonode.prop ('type')
+                    if isinstance (types, basestring):
+                        types = types.split ()
+                    else:
+                        types = []
+                    crname = cremail = None
+                    for crnode in xmliter (infonode):
+                        if _is_ns_name (crnode, MALLARD_NS, 'name'):
+                            crname = normalize (crnode.getContent ())
+                        elif _is_ns_name (crnode, MALLARD_NS, 'email'):
+                            cremail = normalize (crnode.getContent ())
+                    if crname is not None or cremail is not None:
+                        credits.append ((crname, cremail, types))
+                elif _is_ns_name (infonode, MALLARD_NS, 'link'):
+                    process_link_node (infonode)
+        elif _is_ns_name (node, MALLARD_NS, 'title'):
+            if title is None:
+                title = normalize (node.getContent ())
+        elif _is_ns_name (node, MALLARD_NS, 'section'):
+            for child in xmliter (node):
+                if child.type != 'element':
+                    continue
+                if _is_ns_name (child, MALLARD_NS, 'info'):
+                    for infonode in xmliter (child):
+                        if infonode.type != 'element':
+                            continue
+                        if _is_ns_name (infonode, MALLARD_NS, 'link'):
+                            process_link_node (infonode)
+
+    return {'id': pageid, 'title': title, 'desc': desc,
+            'revision': revision, 'credits': credits,
+            'topiclinks': links['topic'], 'guidelinks': links['guide'],
+            'deps': deps}
+
+def get_xinclude_deps (filename, root):
+    """
+    Get the files XIncluded from a document, relative to its directory.
+    """
+    dirname = os.path.dirname (filename)
+    deps = []
+    todo = [(filename, root)]
+    while len(todo) > 0:
+        curfile, curroot = todo.pop (0)
+        for node in _iter_elements (curroot):
+            if not _is_ns_name (node, XINCLUDE_NS, 'include'):
+                continue
+            href = node.prop ('href')
+            if href is None or href == '' or href.find ('://') >= 0:
+                continue
+            incfile = os.path.normpath (os.path.join (os.path.dirname (curfile), href))
+            dep = blip.utils.relative_path (incfile, dirname)
+            if dep in deps:
+                continue
+            deps.append (dep)
+            if node.prop ('parse') == 'text' or not os.path.isfile (incfile):
+                continue
+            try:
+                incdoc = libxml2.readFile (incfile, None, libxml2.XML_PARSE_NONET)
+            except libxml2.libxmlError:
+                continue
+            todo.append ((incfile, incdoc.getRootElement ()))
+    return deps
+
+def get_mallard_page_hash (filename, deps):
+    """
+    Get an MD5 sum of a page and the files it XIncludes.
+    """
+    pagehash = md5 ()
+    dirname = os.path.dirname (filename)
+    for fname in [filename] + [os.path.join (dirname, dep) for dep in deps]:
+        if os.path.isfile (fname):
+            pagehash.update (md5 (open (fname).read ()).hexdigest ())
+        else:
+            pagehash.update ('-')
+    return pagehash.hexdigest ()
+
+def get_mallard_page_links (info):
+    """
+    Get the links a page adds to the topic link graph.
+    """
+    links = set()
+    for xref in info['topiclinks']:
+        links.add ((info['id'], xref))
+    for xref in info['guidelinks']:
+        links.add ((xref, info['id']))
+    return links
+
+def _parse_mallard_page_job (args):
+    # Exceptions are sent back to the parent, where they're recorded
+    # against the document just like in a serial run.  So are the
+    # XmlCatalog hits and misses, which a worker can't count for it.
+    hits, misses = XmlCatalog.hits, XmlCatalog.misses
+    try:
+        info, err = (parse_mallard_page (*args), None)
+    except Exception, err:
+        info = None
+    return (info, err, XmlCatalog.hits - hits, XmlCatalog.misses - misses)
+
+def docbook_info_nodes (filename, streaming=True):
+    """
+    Get the title and info elements at the top of a DocBook document.
+    """
+    options = (libxml2.XML_PARSE_DTDLOAD | libxml2.XML_PARSE_NOCDATA |
+               libxml2.XML_PARSE_NOENT | libxml2.XML_PARSE_NONET)
+    if not streaming:
+        ctxt = libxml2.newParserCtxt ()
+        xmldoc = ctxt.ctxtReadFile (filename, None, options)
+        xmldoc.xincludeProcess ()
+        for node in xmliter (xmldoc.getRootElement ()):
+            if node.type == 'element':
+                yield node
+        return
+
+    reader = libxml2.readerForFile (filename, None, options | libxml2.XML_PARSE_XINCLUDE)
+    try:
+        while True:
+            ret = reader.Read ()
+            if ret == 0:
+                break
+            elif ret < 0:
+                raise libxml2.parserError ('Failed to read %s' % filename)
+            if reader.NodeType () != 1 or reader.Depth () != 1:
+                continue
+            name = reader.LocalName ()
+            if name[-4:] == 'info' or name == 'title':
+                node = reader.Expand ()
+                # The reader only expands XIncludes it steps onto, and it
+                # won't step into this subtree until after we're done.
+                node.xincludeProcessTree ()
+                yield node
+            elif name not in ('subtitle', 'titleabbrev'):
+                break
+    finally:
+        reader.Close ()
+
 def normalize (string):
     if string is None:
         return None
@@ -662,3 +1023,10 @@ def xmliter (node):
     while child:
         yield child
         child = child.next
+
+def _iter_elements (node):
+    for child in xmliter (node):
+        if child.type == 'element':
+            yield child
+            for desc in _iter_elements (child):
+                yield desc
@@ -19,6 +19,9 @@
 # Suite 330, Boston, MA  0211-1307  USA.
 #
 
+import cgi
+import urllib
+
 import blinq.reqs.web
 import blinq.utils
 
@@ -26,7 +29,14 @@ import blip.db
 import blip.html
 import blip.utils
 
+from blip.plugins.gnomedoc.graphs import LinkGraph, GraphRenderer
+
 class PageGraphTab (blip.html.TabProvider):
+    # Guide graphs are rendered while the request waits, so dot gets less
+    # time than it does in the sweep.  The sweep removes old guide graphs,
+    # so subgraphs use the default size it expects.
+    guide_timeout = 10
+
     @classmethod
     def add_tabs (cls, page, request):
         if len(request.path) < 1 or request.path[0] != 'doc':
@@ -49,6 +59,11 @@ class PageGraphTab (blip.html.TabProvider):
         if not blip.html.TabProvider.match_tab (request, 'graph'):
             return None
 
+        cache = blip.db.CacheData.get ((request.record.ident, u'mallard-pages'))
+        guide = request.query.get ('guide', None)
+        if guide is not None:
+            return cls.respond_guide (request, cache, guide)
+
         of = blip.db.OutputFile.select_one (type=u'graphs', ident=request.record.ident, filename=u'topiclinks.svg')
         
         response = blip.web.WebResponse (request)
@@ -67,9 +82,48 @@ class PageGraphTab (blip.html.TabProvider):
         #payload.set_content ('<img src="%s" width="540">' % of.get_blip_url())
         #payload.content_type = 'text/html'
 
-        # So hey, let's use an iframe for now.
-        payload.set_content ('<iframe src="%s" width="560" height="640">' % of.get_blip_url())
+        # So hey, let's use an iframe for now.  Big documents have a list
+        # of guides above it, and each one loads its own graph into it.
+        content = ''
+        guides = []
+        if cache is not None:
+            guides = cache.data.get ('/guides', [])
+        if len(guides) > 1:
+            links = ['<a href="%s" target="graphframe">%s</a>' %
+                     (of.get_blip_url(), cgi.escape (blip.utils.gettext ('All pages')))]
+            for pageid, title in guides:
+                url = '%s?ajax=tab&tab=graph&guide=%s' % (request.record.blip_url,
+                                                         urllib.quote (pageid))
+                links.append ('<a href="%s" target="graphframe">%s</a>' %
+                              (cgi.escape (url, True), cgi.escape (title or pageid)))
+            content += '<div class="graphguides">%s</div>' % ' | '.join (links)
+        content += ('<iframe name="graphframe" src="%s" width="560" height="640">'
+                    % of.get_blip_url())
+        payload.set_content (content)
         payload.content_type = 'text/html'
 
         response.payload = payload
         return response
+
+    @classmethod
+    def respond_guide (cls, request, cache, guide):
+        """
+        Respond with the SVG graph around one guide page.
+        """
+        response = blip.web.WebResponse (request)
+        payload = blinq.reqs.web.TextPayload ()
+        blob = None
+        if cache is not None and cache.data.has_key ('/links'):
+            graph = LinkGraph (cache.data['/links'].keys ())
+            if len(graph.get_links (guide)) > 0:
+                subgraph = graph.get_subgraph (guide)
+                blob = GraphRenderer.render_now (subgraph, timeout=cls.guide_timeout)
+        if blob is None:
+            payload.set_content (cgi.escape (blip.utils.gettext ('No graph is available for %s.')
+                                             % guide))
+            payload.content_type = 'text/html'
+        else:
+            payload.set_content (open (blob).read ())
+            payload.content_type = 'image/svg+xml'
+        response.payload = payload
+        return response
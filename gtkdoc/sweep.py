@@ -35,7 +35,8 @@ import blip.parsers
 import blip.parsers.automake
 
 import blip.plugins.modules.sweep
-from blip.plugins.gnomedoc.sweep import GnomeDocScanner
+from blip.plugins.gnomedoc.sweep import GnomeDocScanner, XmlCatalog, EntityResolver
+from blip.plugins.common.utils import BuildFiles, get_last_revisions
 
 class GtkDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
     def __init__ (self, scanner):
@@ -69,17 +70,10 @@ class GtkDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                         self.translations.append (translation)
                 raise
 
-            makefile = blip.parsers.get_parsed_file (blip.parsers.automake.Automake,
-                                                     self.scanner.branch, filename)
-
-            is_gtk_doc = False
-            if basename == 'Makefile.am':
-                for line in makefile.get_lines():
-                    if line.startswith ('include $(top_srcdir)/'):
-                        if line.endswith ('gtk-doc.make'):
-                            is_gtk_doc = True
-                            break
-            if not is_gtk_doc:
+            makefile = BuildFiles.get (blip.parsers.automake.Automake,
+                                       self.scanner.branch, filename)
+            includes = BuildFiles.get_includes (self.scanner.branch, filename)
+            if 'gtk-doc.make' not in includes:
                 return
 
             stamp.log ()
@@ -116,8 +110,12 @@ class GtkDocScanner (blip.plugins.modules.sweep.ModuleFileScanner):
         for document in self.documents:
             with blip.db.Error.catch (document):
                 GnomeDocScanner.process_docbook (document, self.scanner)
-            rev = blip.db.Revision.get_last_revision (branch=document.parent,
-                                                      files=[os.path.join (document.scm_dir, document.scm_file)])
+        XmlCatalog.log_stats ()
+        EntityResolver.log_stats ()
+        revs = get_last_revisions (self.scanner.branch,
+                                   [[os.path.join (document.scm_dir, document.scm_file)]
+                                    for document in self.documents])
+        for document, rev in zip (self.documents, revs):
             if rev is not None:
                 document.mod_datetime = rev.datetime
                 document.mod_person = rev.person
@@ -20,9 +20,11 @@
 
 import commands
 import datetime
+import difflib
+import multiprocessing
 import re
 import os
-import shutil
+import subprocess
 
 try:
     from hashlib import md5
@@ -37,12 +39,371 @@ import blip.parsers.autoconf
 import blip.parsers.automake
 
 import blip.plugins.modules.sweep
+from blip.plugins.common.utils import BuildFiles, get_last_revisions, store_output_file
+
+def run_msgmerge (branch, pofile, potfile):
+    """
+    Merge a PO file with a POT file with msgmerge and get its statistics.
+    """
+    popen = subprocess.Popen (['msgmerge', pofile, potfile],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    popo = blip.parsers.po.Po (branch, popen.stdout)
+    stats = popo.get_stats ()
+    popen.wait ()
+    return stats
+
+class PoReader:
+    """
+    Read the messages from a PO or POT file a line at a time.
+    """
+
+    def __init__ (self):
+        self._msg = {}
+        self._key = None
+
+    def feed (self, line):
+        """Feed a line, returning a message if the line completed one."""
+        message = None
+        line = line.strip ()
+        if line.startswith ('#~'):
+            line = line[2:].lstrip ()
+        elif line.startswith ('#'):
+            if self._msg.has_key ('msgstr'):
+                message = self.finish ()
+            if line.startswith ('#,'):
+                if 'fuzzy' in [flag.strip () for flag in line[2:].split (',')]:
+                    self._msg['fuzzy'] = True
+            self._key = None
+            return message
+        if line.startswith ('"'):
+            if self._key is not None:
+                self._msg[self._key][-1] += line[1:-1]
+            return None
+        words = line.split (None, 1)
+        if len(words) != 2:
+            self._key = None
+            return None
+        if words[0].startswith ('msgstr'):
+            self._key = 'msgstr'
+        elif words[0] in ('msgctxt', 'msgid', 'msgid_plural'):
+            self._key = words[0]
+            if self._key != 'msgid_plural' and self._msg.has_key ('msgstr'):
+                message = self.finish ()
+        else:
+            self._key = None
+            return None
+        self._msg.setdefault (self._key, []).append (words[1].strip ()[1:-1])
+        return message
+
+    def finish (self):
+        """Finish the current message, returning it if there is one."""
+        msg = self._msg
+        self._msg = {}
+        if not msg.has_key ('msgstr'):
+            return None
+        msgctxt = msg.get ('msgctxt', [None])[0]
+        msgid = msg.get ('msgid', [''])[0]
+        if msgctxt is None and msgid == '':
+            return None
+        return (msgctxt, msgid, msg.get ('msgid_plural', [None])[0],
+                msg['msgstr'], msg.get ('fuzzy', False))
+
+def read_po (fd):
+    """
+    Read the messages from a PO or POT file.
+    """
+    reader = PoReader ()
+    for line in fd:
+        message = reader.feed (line)
+        if message is not None:
+            yield message
+    message = reader.finish ()
+    if message is not None:
+        yield message
+
+class PotFingerprint:
+    """
+    A fingerprint of the messages in a POT file.
+    """
+
+    def __init__ (self):
+        self._reader = PoReader ()
+        self._digests = set ()
+        self._hexdigest = None
+
+    def feed (self, line):
+        message = self._reader.feed (line)
+        if message is not None:
+            self._add (message)
+
+    def finish (self):
+        message = self._reader.finish ()
+        if message is not None:
+            self._add (message)
+        fingerprint = md5 ()
+        for digest in sorted (self._digests):
+            fingerprint.update (digest)
+        self._hexdigest = '%i:%s' % (len(self._digests), fingerprint.hexdigest ())
+
+    def _add (self, message):
+        msgctxt, msgid, msgid_plural = message[:3]
+        key = '\0'.join ([msgctxt or '', msgid, msgid_plural or ''])
+        self._digests.add (md5 (key).digest ())
+
+    def hexdigest (self):
+        return self._hexdigest
+
+    @staticmethod
+    def compare (fingerprint1, fingerprint2):
+        """
+        Check if two fingerprints are for POT files with the same messages.
+        """
+        if fingerprint1 is None or fingerprint2 is None:
+            return False
+        return fingerprint1 == fingerprint2
+
+class MessageIndex:
+    """
+    An index of the messages in a POT file.
+    """
+
+    FUZZY_THRESHOLD = 0.6
+    FUZZY_CANDIDATES = 20
+
+    def __init__ (self, fd):
+        self._messages = {}
+        for msgctxt, msgid, msgid_plural, msgstrs, fuzzy in read_po (fd):
+            self._messages[(msgctxt, msgid)] = msgid_plural
+
+    def get_num_messages (self):
+        return len(self._messages)
+
+    def get_stats (self, fd):
+        """
+        Get the translated, fuzzy, and untranslated counts for a PO file.
+        """
+        translated = fuzzy = 0
+        matched = set ()
+        candidates = []
+        for msgctxt, msgid, msgid_plural, msgstrs, msgfuzzy in read_po (fd):
+            key = (msgctxt, msgid)
+            if not self._messages.has_key (key) or key in matched:
+                if msgstrs[0] != '':
+                    candidates.append ((msgctxt, msgid))
+                continue
+            matched.add (key)
+            if '' in msgstrs:
+                continue
+            if msgfuzzy or msgid_plural != self._messages[key]:
+                fuzzy += 1
+            else:
+                translated += 1
+            candidates.append (key)
+        unmatched = [key for key in self._messages.keys () if key not in matched]
+        if len(unmatched) > 0 and len(candidates) > 0:
+            grams = {}
+            for i in range (len(candidates)):
+                for gram in _trigrams (candidates[i][1]):
+                    grams.setdefault (gram, []).append (i)
+            for msgctxt, msgid in unmatched:
+                if self._fuzzy_match (msgctxt, msgid, candidates, grams):
+                    fuzzy += 1
+        untranslated = len(self._messages) - translated - fuzzy
+        return (translated, fuzzy, untranslated)
+
+    def _fuzzy_match (self, msgctxt, msgid, candidates, grams):
+        counts = {}
+        for gram in _trigrams (msgid):
+            for i in grams.get (gram, []):
+                counts[i] = counts.get (i, 0) + 1
+        best = sorted (counts.keys (), key=lambda i: counts[i], reverse=True)
+        for i in best[:self.FUZZY_CANDIDATES]:
+            candctxt, candid = candidates[i]
+            if candctxt != msgctxt:
+                continue
+            # This bounds the ratio before doing any real work.
+            if 2.0 * min (len(msgid), len(candid)) < self.FUZZY_THRESHOLD * (len(msgid) + len(candid)):
+                continue
+            matcher = difflib.SequenceMatcher (None, msgid, candid, False)
+            if matcher.quick_ratio () < self.FUZZY_THRESHOLD:
+                continue
+            if matcher.ratio () >= self.FUZZY_THRESHOLD:
+                return True
+        return False
+
+def _trigrams (string):
+    if len(string) < 3:
+        return set ([string])
+    return set ([string[i:i+3] for i in range (len(string) - 2)])
+
+_merge_index = None
+def _init_merge (index):
+    global _merge_index
+    _merge_index = index
+
+def merge_translation (pofile):
+    """
+    Get the message statistics for a PO file against the current POT index.
+    """
+    return _merge_index.get_stats (open (pofile))
+
+def get_pot_hash (potfile):
+    """
+    Get a key for the messages in a POT file's OutputFile record.
+    """
+    pothash = potfile.data.get ('md5', None)
+    if pothash is None:
+        pothash = md5 (open (potfile.get_file_path ()).read ()).hexdigest ()
+    return pothash
+
+class StatsCache:
+    """
+    Translation statistics keyed by a PO file's MD5 sum and a POT hash.
+    """
+
+    def __init__ (self, ident):
+        self._cache = blip.db.CacheData.get ((ident, u'po-stats'))
+        if self._cache is None:
+            self._cache = blip.db.CacheData (ident=ident, key=u'po-stats')
+        self._today = blip.utils.daynum ()
+        for key in self._cache.data.keys ():
+            if self._cache.data[key][0] < self._today - 30:
+                del self._cache.data[key]
+
+    def get_stats (self, pohash, pothash):
+        """Get the cached statistics for a PO and POT file, or None."""
+        entry = self._cache.data.get (pohash + ':' + pothash)
+        if entry is None:
+            return None
+        if entry[0] != self._today:
+            entry[0] = self._today
+        return entry[1]
+
+    def set_stats (self, pohash, pothash, stats):
+        """Set the cached statistics for a PO and POT file."""
+        self._cache.data[pohash + ':' + pothash] = [self._today, stats]
+
+class SourceIndex:
+    """
+    Source files with translatable strings, keyed by the MD5 sum of each file.
+    """
+
+    c_markers = re.compile (r'\b(?:_|N_|C_|NC_|Q_|gettext|dgettext|ngettext|dngettext|'
+                            r'g_dgettext|g_dngettext|g_dpgettext2?)\s*\(')
+    py_markers = re.compile (r'\b(?:_|N_|C_|gettext|ngettext|pgettext)\s*\(')
+    ui_markers = re.compile (r'translatable\s*=\s*["\'](?:yes|true)["\']')
+    xml_markers = re.compile (r'<_[\w:-]+|\s_[\w:-]+\s*=')
+    keys_markers = re.compile (r'^_[\w\[\]@.-]+\s*=', re.M)
+
+    markers = [
+        (('.c', '.h', '.cc', '.cpp', '.cxx', '.c++', '.hh', '.vala', '.y'), c_markers),
+        (('.py', '.js'), py_markers),
+        (('.glade', '.ui'), ui_markers),
+        (('.xml.in', '.schemas.in', '.policy.in', '.server.in', '.gschema.xml.in'), xml_markers),
+        (('.desktop.in', '.directory.in', '.keys.in'), keys_markers)
+        ]
+
+    def __init__ (self, branch, topdir):
+        self._ident = branch.ident
+        self._topdir = topdir
+        self._files = []
+        self._cache = None
+        self._marked = None
+
+    @classmethod
+    def get_markers (cls, basename):
+        """Get the gettext marker pattern for a file name, or None."""
+        for exts, regex in cls.markers:
+            for ext in exts:
+                if basename.endswith (ext):
+                    return regex
+        return None
+
+    def add_file (self, dirname, basename):
+        """Add a candidate source file if it could have translatable strings."""
+        if self.get_markers (basename) is None:
+            return
+        self._files.append (blip.utils.relative_path (os.path.join (dirname, basename),
+                                                      self._topdir))
+        self._marked = None
+
+    def get_marked (self):
+        """Get the set of files with gettext markers, relative to the top directory."""
+        if self._marked is not None:
+            return self._marked
+        # The cache is only loaded when a POT file is checked, so branches
+        # without a po directory don't get a record.
+        if self._cache is None:
+            self._cache = blip.db.CacheData.get ((self._ident, u'intltool-markers'))
+            if self._cache is None:
+                self._cache = blip.db.CacheData (ident=self._ident, key=u'intltool-markers')
+        self._marked = set()
+        data = {}
+        scanned = 0
+        for rel in self._files:
+            try:
+                content = open (os.path.join (self._topdir, rel)).read ()
+            except IOError:
+                continue
+            filemd5 = md5 (content).hexdigest ()
+            entry = self._cache.data.get (rel)
+            if entry is None or entry[0] != filemd5:
+                entry = [filemd5, self.get_markers (rel).search (content) is not None]
+                scanned += 1
+            data[rel] = entry
+            if entry[1]:
+                self._marked.add (rel)
+        # Files that have been removed are dropped from the cache.
+        for rel in self._cache.data.keys ():
+            if not data.has_key (rel):
+                del self._cache.data[rel]
+        self._cache.data.update (data)
+        blip.utils.log ('Searched %i of %i source files for translatable strings'
+                        % (scanned, len(data)))
+        return self._marked
+
+    def get_missing (self, indir):
+        """
+        Get files with translatable strings that aren't listed for a po directory.
+        """
+        listed = set()
+        for basename in ('POTFILES.in', 'POTFILES.skip'):
+            filename = os.path.join (indir, basename)
+            if not os.path.isfile (filename):
+                continue
+            for line in open (filename):
+                line = line.strip ()
+                if line == '' or line.startswith ('#'):
+                    continue
+                if line.startswith ('[') and line.find (']') > 0:
+                    line = line[line.find (']') + 1:].strip ()
+                line = os.path.normpath (line)
+                listed.add (line)
+                if line.endswith ('.in'):
+                    listed.add (line[:-3])
+        srcdir = blip.utils.relative_path (os.path.dirname (indir), self._topdir)
+        if srcdir in ('', os.curdir):
+            srcdir = ''
+        else:
+            srcdir = srcdir + os.sep
+        podir = os.path.basename (indir) + os.sep
+        missing = []
+        for rel in self.get_marked ():
+            if not rel.startswith (srcdir):
+                continue
+            rel = rel[len(srcdir):]
+            if rel in listed or rel.startswith (podir):
+                continue
+            missing.append (rel)
+        missing.sort ()
+        return missing
 
 class IntltoolScanner (blip.plugins.modules.sweep.ModuleFileScanner):
     def __init__ (self, scanner):
         self.podirs = []
         self.gettext_package = None
         blip.plugins.modules.sweep.ModuleFileScanner.__init__ (self, scanner)
+        self.sources = SourceIndex (scanner.branch, scanner.repository.directory)
     
     def process_file (self, dirname, basename):
         if (dirname == self.scanner.repository.directory and
@@ -51,11 +412,13 @@ class IntltoolScanner (blip.plugins.modules.sweep.ModuleFileScanner):
             with blip.db.Timestamp.stamped (filename, self.scanner.repository) as stamp:
                 stamp.check (self.scanner.request.get_tool_option ('timestamps'))
                 stamp.log ()
-                autoconf = blip.parsers.get_parsed_file (blip.parsers.autoconf.Autoconf,
-                                                         self.scanner.branch, filename)
+                autoconf = BuildFiles.get (blip.parsers.autoconf.Autoconf,
+                                           self.scanner.branch, filename)
                 self.scanner.branch.data['gettext_package'] = autoconf.get_variable ('GETTEXT_PACKAGE')
         elif basename == 'POTFILES.in':
             self.podirs.append (dirname)
+        else:
+            self.sources.add_file (dirname, basename)
 
     def post_process (self):
         for dirname in self.podirs:
@@ -67,8 +430,8 @@ class IntltoolScanner (blip.plugins.modules.sweep.ModuleFileScanner):
         gettext_package = self.scanner.branch.data.get ('gettext_package', '')
         filename = os.path.join (dirname, 'Makefile.in.in')
         if os.path.exists (filename):
-            makefile = blip.parsers.get_parsed_file (blip.parsers.automake.Automake,
-                                                     self.scanner.branch, filename)
+            makefile = BuildFiles.get (blip.parsers.automake.Automake,
+                                       self.scanner.branch, filename)
             if makefile.has_key ('GETTEXT_PACKAGE'):
                 gettext_package = makefile['GETTEXT_PACKAGE'].replace ('@GETTEXT_PACKAGE@',
                                                                        gettext_package)
@@ -128,81 +491,112 @@ class IntltoolScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                 translation.parent = domain
             domain.set_children (u'Translation', translations)
 
-        for translation in translations:
-            self.update_translation (translation)
-
-    def update_translation (self, translation):
-        # FIXME: We regenerate potfile even if no translations are updated,
-        # because changes in various source files could affect it. Can we
-        # somehow skip this when unnecessary? Possibly checking the repo
-        # revision number?
-        potfile = IntltoolScanner.get_potfile (translation, self.scanner)
+        self.update_translations (translations)
+
+    def update_translations (self, translations):
+        # We check the potfile even if no translations are updated, because
+        # changes in various source files could affect it. get_potfile only
+        # regenerates it when the fingerprint of those files has changed.
+        if len(translations) == 0:
+            return
+        potfile = IntltoolScanner.get_potfile (translations[0], self.scanner, self.sources)
         if potfile is None:
             return
 
-        filename = os.path.join (self.scanner.repository.directory,
-                                 translation.scm_dir,
-                                 translation.scm_file)
-        if not os.path.exists (filename):
-            blip.db.Error.set_error (translation.ident,
-                                     blip.utils.gettext ('File %s does not exist') %
+        # Stats for every PO file are looked up in the cache by the MD5 sum
+        # of the PO file and the POT fingerprint, so the cache stays fresh
+        # and header changes like POT-Creation-Date don't invalidate it.
+        # Misses are counted against a MessageIndex for the POT file, in a
+        # pool of worker processes if the msgmerge_jobs option asks for
+        # one.  With the msgmerge_verify option, the counts are checked
+        # against real msgmerge output.  Timestamps are only checked and
+        # recorded back here, as each translation is updated.
+        cache = StatsCache (translations[0].parent.ident)
+        pothash = get_pot_hash (potfile)
+        jobs = []
+        for translation in translations:
+            filename = os.path.join (self.scanner.repository.directory,
+                                     translation.scm_dir,
                                      translation.scm_file)
-            return
+            if not os.path.exists (filename):
+                blip.db.Error.set_error (translation.ident,
+                                         blip.utils.gettext ('File %s does not exist') %
+                                         translation.scm_file)
+                continue
+            pohash = md5 (open (filename).read ()).hexdigest ()
+            jobs.append ((translation, filename, pohash))
 
-        with blip.db.Timestamp.stamped (filename, self.scanner.repository) as stamp:
-            stamp.check (self.scanner.request.get_tool_option ('timestamps'))
+        misses = {}
+        for translation, filename, pohash in jobs:
+            if cache.get_stats (pohash, pothash) is None:
+                misses[pohash] = filename
+        args = misses.values ()
+        if len(args) > 0:
+            index = MessageIndex (open (potfile.get_file_path ()))
+            numjobs = int (self.scanner.request.get_tool_option ('msgmerge_jobs', 1))
+            if numjobs > 1 and len(args) > 1:
+                pool = multiprocessing.Pool (min (numjobs, len(args)),
+                                             _init_merge, (index,))
+                try:
+                    results = pool.map (merge_translation, args)
+                finally:
+                    pool.close ()
+                    pool.join ()
+            else:
+                _init_merge (index)
+                results = map (merge_translation, args)
+            verify = self.scanner.request.get_tool_option ('msgmerge_verify', False)
+            for pohash, filename, stats in zip (misses.keys (), args, results):
+                if verify:
+                    mstats = run_msgmerge (self.scanner.branch, filename,
+                                           potfile.get_file_path ())
+                    if tuple (mstats) != tuple (stats):
+                        blip.utils.warn ('Counts for %s differ from msgmerge: %s, %s' %
+                                         (filename, str(stats), str(mstats)))
+                cache.set_stats (pohash, pothash, stats)
 
-            podir = os.path.join (self.scanner.repository.directory,
-                                  translation.scm_dir)
-            cmd = 'msgmerge "%s" "%s" 2>&1' % (translation.scm_file, potfile.get_file_path ())
-            owd = os.getcwd ()
-            try:
-                os.chdir (podir)
+        revisions = get_last_revisions (translations[0].parent.parent,
+                                        [[os.path.join (translation.scm_dir, translation.scm_file)]
+                                         for translation, filename, pohash in jobs])
+        for (translation, filename, pohash), revision in zip (jobs, revisions):
+            with blip.db.Timestamp.stamped (filename, self.scanner.repository) as stamp:
+                stamp.check (self.scanner.request.get_tool_option ('timestamps'))
                 stamp.log ()
-                popo = blip.parsers.po.Po (self.scanner.branch, os.popen (cmd))
-                stats = popo.get_stats ()
-                total = stats[0] + stats[1] + stats[2]
-                blip.db.Statistic.set_statistic (translation,
-                                                 blip.utils.daynum (),
-                                                 u'Messages',
-                                                 stats[0], stats[1], total)
-            finally:
-                os.chdir (owd)
-
-            of = blip.db.OutputFile.select_one (type=u'l10n',
-                                                ident=translation.parent.ident,
-                                                filename=translation.scm_file)
-            if of is None:
-                of = blip.db.OutputFile (type=u'l10n',
-                                         ident=translation.parent.ident,
-                                         filename=translation.scm_file,
-                                         datetime=datetime.datetime.utcnow ())
-            outfile_abs = of.get_file_path ()
-            outfile_rel = blip.utils.relative_path (outfile_abs,
-                                                    os.path.join (blinq.config.web_files_dir, 'l10n'))
-            outdir = os.path.dirname (outfile_abs)
-            if not os.path.exists (outdir):
-                os.makedirs (outdir)
-            blip.utils.log ('Copying PO file %s' % outfile_rel)
-            shutil.copyfile (os.path.join (self.scanner.repository.directory,
-                                           translation.scm_dir,
-                                           translation.scm_file),
-                             outfile_abs)
+                stats = cache.get_stats (pohash, pothash)
+                self.update_translation (translation, filename, potfile, stats, revision)
+
+    def update_translation (self, translation, filename, potfile, stats, revision):
+        total = stats[0] + stats[1] + stats[2]
+        blip.db.Statistic.set_statistic (translation,
+                                         blip.utils.daynum (),
+                                         u'Messages',
+                                         stats[0], stats[1], total)
+
+        of = blip.db.OutputFile.select_one (type=u'l10n',
+                                            ident=translation.parent.ident,
+                                            filename=translation.scm_file)
+        if of is None:
+            of = blip.db.OutputFile (type=u'l10n',
+                                     ident=translation.parent.ident,
+                                     filename=translation.scm_file,
+                                     datetime=datetime.datetime.utcnow ())
+        outfile_abs = of.get_file_path ()
+        outfile_rel = blip.utils.relative_path (outfile_abs,
+                                                os.path.join (blinq.config.web_files_dir, 'l10n'))
+        if store_output_file (of, filename):
+            blip.utils.log ('Copied PO file %s' % outfile_rel)
             of.datetime = datetime.datetime.utcnow ()
-            of.data['revision'] = self.scanner.repository.get_revision ()
+        of.data['revision'] = self.scanner.repository.get_revision ()
 
-            files = [os.path.join (translation.scm_dir, translation.scm_file)]
-            revision = blip.db.Revision.get_last_revision (branch=translation.parent.parent,
-                                                           files=files)
-            if revision is not None:
-                translation.mod_datetime = revision.datetime
-                translation.mod_person = revision.person
+        if revision is not None:
+            translation.mod_datetime = revision.datetime
+            translation.mod_person = revision.person
 
-            translation.data['md5'] = potfile.data.get ('md5', None)
+        translation.data['md5'] = potfile.data.get ('md5', None)
 
     potfiles = {}
     @classmethod
-    def get_potfile (cls, translation, scanner):
+    def get_potfile (cls, translation, scanner, sources=None):
         domain = translation.parent
         indir = os.path.join (scanner.repository.directory,
                               domain.scm_dir)
@@ -229,47 +623,48 @@ class IntltoolScanner (blip.plugins.modules.sweep.ModuleFileScanner):
                 cls.potfiles[indir] = of
                 return of
 
-        potdir = os.path.dirname (potfile_abs)
-        if not os.path.exists (potdir):
-            os.makedirs (potdir)
+        # New source files can be missing from POTFILES.in without changing
+        # the fingerprint, so this is checked even if the POT file isn't.
+        if sources is not None:
+            of.data['missing'] = sources.get_missing (indir)
 
-        cmd = 'intltool-update -p -g "%s" && mv "%s" "%s"' % (potname, potfile, potdir)
+        fingerprint = cls.get_fingerprint (indir, potname)
+        if not scanner.request.get_tool_option ('timestamps'):
+            if (of.data.get ('fingerprint') == fingerprint and
+                os.path.exists (potfile_abs)):
+                blip.utils.log ('Skipping unchanged POT file %s' % potfile_rel)
+                of.data['mod_datetime'] = domain.parent.mod_datetime
+                cls.potfiles[indir] = of
+                return of
+
+        cmd = 'intltool-update -p -g "%s"' % potname
         owd = os.getcwd ()
         try:
             os.chdir (indir)
             blip.utils.log ('Creating POT file %s' % potfile_rel)
-            (mstatus, moutput) = commands.getstatusoutput (
-                'rm -f missing notexist && intltool-update -m')
             (status, output) = commands.getstatusoutput (cmd)
         finally:
             os.chdir (owd)
 
-        missing = []
-        if mstatus == 0:
-            mfile = os.path.join (indir, 'missing')
-            if os.access (mfile, os.R_OK):
-                missing = [line.strip() for line in open(mfile).readlines()]
-
         if status == 0:
-            potmd5 = md5 ()
-            # We don't start feeding potmd5 until we've hit a blank line.
-            # This keeps inconsequential differences in the header from
-            # affecting the MD5.
-            blanklink = False
+            # The fingerprint ignores the header and comments, so it only
+            # changes when the messages themselves change.
+            potprint = PotFingerprint ()
             popo = blip.parsers.po.Po (scanner.branch)
-            for line in open (potfile_abs):
-                if blanklink:
-                    potmd5.update (line)
-                elif line.strip() == '':
-                    blankline = True
+            newpot = os.path.join (indir, potfile)
+            for line in open (newpot):
+                potprint.feed (line)
                 popo.feed (line)
+            potprint.finish ()
             popo.finish ()
             num = popo.get_num_messages ()
-            of.datetime = datetime.datetime.utcnow ()
+            if store_output_file (of, newpot):
+                of.datetime = datetime.datetime.utcnow ()
+            os.remove (newpot)
             of.data['mod_datetime'] = domain.parent.mod_datetime
-            of.data['missing'] = missing
             of.statistic = num
-            of.data['md5'] = potmd5.hexdigest ()
+            of.data['md5'] = potprint.hexdigest ()
+            of.data['fingerprint'] = fingerprint
             cls.potfiles[indir] = of
             translation.parent.updated = of.datetime
             return of
@@ -278,3 +673,34 @@ class IntltoolScanner (blip.plugins.modules.sweep.ModuleFileScanner):
             blip.utils.warn ('Failed to create POT file %s' % potfile_rel)
             cls.potfiles[indir] = None
             return None
+
+    @classmethod
+    def get_fingerprint (cls, indir, potname):
+        """
+        Get a fingerprint of everything that goes into a POT file.
+        """
+        fingerprint = md5 ()
+        fingerprint.update (potname.encode ('utf-8') + '\0')
+        for basename in ('POTFILES.in', 'POTFILES.skip', 'Makefile.in.in'):
+            filename = os.path.join (indir, basename)
+            if os.path.isfile (filename):
+                fingerprint.update (basename + '\0' + md5 (open (filename).read ()).hexdigest ())
+        filename = os.path.join (indir, 'POTFILES.in')
+        if not os.path.isfile (filename):
+            return fingerprint.hexdigest ()
+        # Files in POTFILES.in are relative to the top source directory,
+        # and may be prefixed with a type, as in [type: gettext/glade].
+        topdir = os.path.dirname (indir)
+        for line in open (filename):
+            line = line.strip ()
+            if line == '' or line.startswith ('#'):
+                continue
+            if line.startswith ('[') and line.find (']') > 0:
+                line = line[line.find (']') + 1:].strip ()
+            srcfile = os.path.join (topdir, line)
+            fingerprint.update (line + '\0')
+            if os.path.isfile (srcfile):
+                fingerprint.update (md5 (open (srcfile).read ()).hexdigest ())
+            else:
+                fingerprint.update ('-')
+        return fingerprint.hexdigest ()
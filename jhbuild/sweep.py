@@ -18,15 +18,27 @@
 # Suite 330, Boston, MA  0211-1307  USA.
 #
 
+import cStringIO
+import multiprocessing
 import os
 import sys
+import urlparse
 
 import xml.dom.minidom
+import xml.etree.cElementTree
+
+try:
+    from hashlib import md5
+except:
+    from md5 import new as md5
+
+import blinq.config
 
 import blip.data
 import blip.db
 import blip.scm
 import blip.sweep
+import blip.utils
 
 import blip.plugins.sets.sweep
 
@@ -52,42 +64,98 @@ class JHBuildSetSweeper (blip.plugins.sets.sweep.SetSweeper):
                                  data['jhbuild_scm_file'])
 
         if not cls.modulesets.has_key (filename):
-            cls.modulesets[filename] = ModuleSet (filename)
+            streaming = not request.get_tool_option ('jhbuild_minidom', False)
+            workers = int (request.get_tool_option ('jhbuild_workers', 1))
+            mirror = request.get_tool_option ('jhbuild_mirror', None)
+            cls.modulesets[filename] = ModuleSet (filename, streaming=streaming,
+                                                  workers=workers, mirror=mirror)
         moduleset = cls.modulesets[filename]
 
-        packages = []
         if not data.has_key ('jhbuild_metamodule'):
-            packages = moduleset.get_metamodule (os.path.basename (filename))
+            modules = [os.path.basename (filename)]
         else:
             modules = data['jhbuild_metamodule']
             if isinstance (modules, basestring):
                 modules = [modules]
 
-            for module in modules:
-                if not moduleset.has_metamodule (module):
-                    continue
-                packages += moduleset.get_metamodule (module)
-
-        newpkgs = []
-        while len(packages) > 0:
-            pkg = packages.pop ()
-            if moduleset.has_package (pkg):
-                newpkgs.append (pkg)
-            elif moduleset.has_metamodule (pkg):
-                for npkg in moduleset.get_metamodule (pkg):
-                    packages.append (npkg)
-        packages = newpkgs
+        packages = []
+        seen = set ()
+        for module in modules:
+            if not moduleset.has_metamodule (module):
+                continue
+            for pkg in moduleset.get_expanded_metamodule (module):
+                if pkg not in seen:
+                    seen.add (pkg)
+                    packages.append (pkg)
+
+        digests = {}
+        for pkg in packages:
+            digests[pkg] = get_package_digest (moduleset.get_package (pkg))
+        setmd5 = md5 ()
+        for pkg in sorted (digests.keys ()):
+            setmd5.update ((u'%s %s\n' % (pkg, digests[pkg])).encode ('utf-8'))
+        fingerprint = setmd5.hexdigest ()
+
+        # When timestamps are honored, sets whose packages are unchanged since
+        # the last sweep are skipped, and only changed packages are updated.
+        oldpkgs = {}
+        if not request.get_tool_option ('timestamps'):
+            if record.data.get ('jhbuild_fingerprint') == fingerprint:
+                blip.utils.log ('Skipping unchanged set %s' % record.ident)
+                # A skipped set still comes first for its branches, so later
+                # sets mustn't overwrite their dependencies.
+                for digest, ident in record.data.get ('jhbuild_packages', {}).values ():
+                    cls.deprecords.add (ident)
+                return
+            oldpkgs = record.data.get ('jhbuild_packages', {})
+        known = {}
+        changed = set ()
+        for pkg in packages:
+            if oldpkgs.has_key (pkg) and oldpkgs[pkg][0] == digests[pkg]:
+                known[pkg] = oldpkgs[pkg][1]
+            else:
+                changed.add (pkg)
+        for pkg in oldpkgs.keys ():
+            if not digests.has_key (pkg):
+                changed.add (pkg)
+        blip.utils.log ('Set %s has %i changed packages' % (record.ident, len(changed)))
 
         rels = []
+        for branch in cls.update_branches (record, moduleset, packages, known):
+            rels.append (blip.db.SetModule.set_related (record, branch))
+        record.set_relations (blip.db.SetModule, rels)
+        cls.estimated_queries[record.ident] += len(rels) + 1
+
+        # Dependency relations change when a package or anything it depends
+        # on has changed.  The graph drops dependencies that aren't in the
+        # moduleset, so packages that name a changed package in their own
+        # deps are found from the raw lists.  That covers dependencies that
+        # have left the set, and anything depending on those packages.
+        graph = moduleset.get_dependency_graph ()
+        touched = set ()
+        for pkg in packages:
+            if pkg in changed or changed.intersection (moduleset.get_package (pkg).get ('deps', [])):
+                touched.add (pkg)
+        deppkgs = [pkg for pkg in packages
+                   if pkg in touched or touched.intersection (graph.get_deps (pkg))]
+        cls.estimated_queries[record.ident] += cls.update_deps (moduleset, deppkgs)
+        cls.claim_deps (moduleset, packages)
+        blip.utils.log ('Estimated %i queries for set %s' %
+                        (cls.estimated_queries[record.ident], record.ident))
+
+        newpkgs = {}
         for pkg in packages:
-            # FIXME
-            branch = cls.update_branch (moduleset, pkg, request)
+            branch = moduleset.get_package (pkg).get ('__record__')
             if branch is not None:
-                rels.append (blip.db.SetModule.set_related (record, branch))
-        record.set_relations (blip.db.SetModule, rels)
+                newpkgs[pkg] = [digests[pkg], branch.ident]
+        record.data['jhbuild_packages'] = newpkgs
+        record.data['jhbuild_fingerprint'] = fingerprint
 
     @classmethod
-    def update_branch (cls, moduleset, key, request):
+    def get_branch_data (cls, moduleset, key):
+        """
+        Get the Branch ident and scm fields for a package in a moduleset.
+        """
         if not moduleset.has_package (key):
             return None
         pkg_data = moduleset.get_package (key)
@@ -97,37 +165,184 @@ class JHBuildSetSweeper (blip.plugins.sets.sweep.SetSweeper):
             if k[:4] == 'scm_':
                 data[k] = pkg_data[k]
 
-        try:
-            repo = blip.scm.Repository (checkout=False, update=False, **pkg_data)
-        except blip.scm.RepositoryError, err:
-            blip.utils.warn (err.message)
-            return
-        servername = repo.server_name
+        resolved = cls.resolve_server (pkg_data)
+        if resolved is None:
+            return None
+        servername, scm_branch = resolved
         if servername == None:
             return None
         if not 'scm_branch' in pkg_data:
-            pkg_data['scm_branch'] = repo.scm_branch
+            pkg_data['scm_branch'] = scm_branch
         ident = u'/'.join (['/mod', servername, pkg_data['scm_module'], pkg_data['scm_branch']])
-        record = blip.db.Branch.get_or_create (ident, u'Module')
-        record.update (data)
-        if pkg_data.has_key ('autogenargs'):
-            record.data['configure_args'] = pkg_data['autogenargs']
-        pkg_data['__record__'] = record
+        return (ident, data)
+
+    resolved_servers = {}
+    resolver_hits = 0
+    resolver_misses = 0
+
+    @classmethod
+    def resolve_server (cls, pkg_data):
+        """
+        Get the server name and default branch for a package.
+        """
+        key = (pkg_data.get ('scm_type'), pkg_data.get ('scm_server'),
+               pkg_data.has_key ('scm_branch'))
+        if cls.resolved_servers.has_key (key):
+            cls.resolver_hits += 1
+            return cls.resolved_servers[key]
+        cls.resolver_misses += 1
+        try:
+            repo = blip.scm.Repository (checkout=False, update=False, **pkg_data)
+            resolved = (repo.server_name, repo.scm_branch)
+        except blip.scm.RepositoryError, err:
+            blip.utils.warn (err.message)
+            resolved = None
+        cls.resolved_servers[key] = resolved
+        return resolved
 
-        # FIXME: do we want to do deps from jhbuild?
-        #records.setdefault (record.ident, {'record' : record, 'pkgdatas' : []})
-        # Records could have package information defined in multiple modulesets,
-        # so we record all of them.  See the comment in update_deps.
-        #records[record.ident]['pkgdatas'].append ((moduleset, key))
+    # Estimated number of database statements for each set, keyed by the
+    # set ident.  These are counted by hand, not taken from the store: one
+    # for each select, one for each branch created or changed, and one for
+    # each relation written.  Statements the store issues on its own, like
+    # lazy loads, aren't included.
+    estimated_queries = {}
 
-        return record
+    @classmethod
+    def update_branches (cls, record, moduleset, keys, known={}):
+        """
+        Create or update the Branch records for packages in a moduleset.
+        """
+        pkgs = []
+        idents = []
+        for key in keys:
+            if known.has_key (key):
+                pkgs.append ((key, known[key], None))
+                idents.append (known[key])
+                continue
+            branch_data = cls.get_branch_data (moduleset, key)
+            if branch_data is None:
+                continue
+            ident, data = branch_data
+            pkgs.append ((key, ident, data))
+            idents.append (ident)
+
+        trips = 0
+        branches = {}
+        if len(idents) > 0:
+            for branch in blip.db.Branch.select (blip.db.Branch.ident.is_in (idents)):
+                branches[branch.ident] = branch
+            trips += 1
+
+        records = []
+        for key, ident, data in pkgs:
+            pkg_data = moduleset.get_package (key)
+            if data is None:
+                if branches.has_key (ident):
+                    pkg_data['__record__'] = branches[ident]
+                    records.append (branches[ident])
+                    continue
+                # The branch went away since the last sweep
+                branch_data = cls.get_branch_data (moduleset, key)
+                if branch_data is None:
+                    continue
+                ident, data = branch_data
+            branch = branches.get (ident)
+            if branch is None:
+                # New branches are inserted one at a time when the store flushes
+                branch = blip.db.Branch (ident=ident, type=u'Module')
+                branches[ident] = branch
+                changed = True
+            else:
+                changed = False
+                for k in data.keys():
+                    if getattr (branch, k, None) != data[k]:
+                        changed = True
+                        break
+            if changed:
+                branch.update (data)
+                trips += 1
+            if pkg_data.has_key ('autogenargs'):
+                if branch.data.get ('configure_args') != pkg_data['autogenargs']:
+                    branch.data['configure_args'] = pkg_data['autogenargs']
+            pkg_data['__record__'] = branch
+            records.append (branch)
+
+        cls.estimated_queries[record.ident] = trips
+        blip.utils.log ('Updated %i branches for %s in about %i queries' %
+                        (len(records), record.ident, trips))
+        blip.utils.log ('Resolved servers with %i hits and %i misses' %
+                        (cls.resolver_hits, cls.resolver_misses))
+        return records
+
+    deprecords = set ()
+
+    @classmethod
+    def update_deps (cls, moduleset, packages):
+        # Records could have package information defined in multiple modulesets.
+        # If the jhbuild maintainers are on the ball, the dependencies in either
+        # should be equivalent, except they might end up pointing to different
+        # branches, as a result of what branches of other modules are included
+        # in the particular moduleset.
+        #
+        # I toyed around with having dependencies go from Branch to Branchable,
+        # which would make this a moot point, but it makes it difficult to do
+        # dependency graphs, because you have to arbitrarily choose branches
+        # of dependencies, and that could affect further dependencies.
+        #
+        # So we arbitrarity take the first moduleset.  It's probably a good
+        # idea to keep newer modulesets first in sets.xml.
+        #
+        # Returns the estimated number of statements, one for each relation
+        # written and one for each package whose relations are set.
+        queries = 0
+        graph = moduleset.get_dependency_graph ()
+        for pkg in packages:
+            pkgdata = moduleset.get_package (pkg)
+            rec = pkgdata.get ('__record__')
+            if rec is None or rec.ident in cls.deprecords:
+                continue
+            cls.deprecords.add (rec.ident)
+            pkgrels = []
+            for dep in graph.get_deps (pkg):
+                deprec = moduleset.get_package (dep).get ('__record__')
+                if deprec is None:
+                    continue
+                rel = blip.db.ModuleDependency.set_related (rec, deprec)
+                direct = graph.is_direct (pkg, dep)
+                if rel.direct != direct:
+                    rel.direct = direct
+                pkgrels.append (rel)
+            rec.set_relations (blip.db.ModuleDependency, pkgrels)
+            queries += len(pkgrels) + 1
+        return queries
+
+    @classmethod
+    def claim_deps (cls, moduleset, packages):
+        """
+        Mark the branches of packages as having their dependencies decided.
+        """
+        for pkg in packages:
+            rec = moduleset.get_package (pkg).get ('__record__')
+            if rec is not None:
+                cls.deprecords.add (rec.ident)
 
 class ModuleSet:
-    def __init__ (self, filename):
+    # Cached items from an older cache_format are parsed again.  This needs
+    # to be bumped whenever parse_items_dom or parse_items_stream changes
+    # the items it gives.
+    cache_format = 1
+
+    def __init__ (self, filename, streaming=True, workers=1, mirror=None):
         self._packages = {}
         self._metas = {}
+        self._includes = {}
         self.filename = filename
+        self.streaming = streaming
+        self.workers = workers
+        self.mirror = mirror
         self.parse (filename)
+        self._expanded = self.expand_metamodules ()
+        self._graph = None
 
     def get_packages (self):
         return self._packages.keys()
@@ -147,9 +362,172 @@ class ModuleSet:
     def get_metamodule (self, key):
         return self._metas[key]
 
+    def get_expanded_metamodule (self, key):
+        return self._expanded[key]
+
+    def get_dependency_graph (self):
+        if self._graph is None:
+            self._graph = DependencyGraph (self)
+            for cycle in self._graph.get_cycles ():
+                blip.utils.warn ('Circular dependency in %s: %s' %
+                                 (os.path.basename (self.filename), ', '.join (sorted (cycle))))
+        return self._graph
+
+    def expand_metamodules (self):
+        """
+        Expand every metamodule into the packages it transitively contains.
+        """
+        def successors (key):
+            return [dep for dep in self._metas[key]
+                    if not self._packages.has_key (dep) and self._metas.has_key (dep)]
+        expanded = {}
+        for scc in strongly_connected_components (sorted (self._metas.keys ()), successors):
+            members = set (scc)
+            visited = set ()
+            seen = set ()
+            packages = []
+            for start in reversed (scc):
+                if start in visited:
+                    continue
+                visited.add (start)
+                work = [iter (self._metas[start])]
+                while len(work) > 0:
+                    for dep in work[-1]:
+                        if self._packages.has_key (dep):
+                            if dep not in seen:
+                                seen.add (dep)
+                                packages.append (dep)
+                        elif dep in members:
+                            if dep not in visited:
+                                visited.add (dep)
+                                work.append (iter (self._metas[dep]))
+                                break
+                        elif expanded.has_key (dep):
+                            for pkg in expanded[dep]:
+                                if pkg not in seen:
+                                    seen.add (pkg)
+                                    packages.append (pkg)
+                    else:
+                        work.pop ()
+            for key in scc:
+                expanded[key] = packages
+        return expanded
+
     def parse (self, filename):
+        files = self.load_files (filename)
+        self.merge_files (filename, files, set ())
+
+    def merge_files (self, filename, files, stack):
         base = os.path.basename (filename)
-        dom = xml.dom.minidom.parse (filename)
+        stack.add (filename)
+        for item in files[filename]:
+            if item[0] == 'package':
+                pkg_data = dict (item[1])
+                if pkg_data.has_key ('deps'):
+                    pkg_data['deps'] = list (pkg_data['deps'])
+                self._packages[pkg_data['id']] = pkg_data
+                self._metas.setdefault (base, [])
+                self._metas[base].append (pkg_data['id'])
+            elif item[0] == 'metamodule':
+                self._metas[item[1]] = list (item[2])
+            elif item[0] == 'include':
+                incname = self.resolve_include (filename, item[1])
+                if incname is not None and incname not in stack:
+                    self.merge_files (incname, files, stack)
+        stack.discard (filename)
+
+    def resolve_include (self, filename, href):
+        """
+        Get the file name for an include in a moduleset file.
+        """
+        key = (filename, href)
+        if not self._includes.has_key (key):
+            if href.startswith ('http:') or href.startswith ('https:'):
+                incname = None
+                if self.mirror is not None:
+                    url = urlparse.urlsplit (href)
+                    incname = os.path.join (self.mirror, url.netloc, url.path.lstrip ('/'))
+                    if not os.path.exists (incname):
+                        blip.utils.warn ('Could not find %s in moduleset mirror' % href)
+                        incname = None
+            else:
+                incname = os.path.join (os.path.dirname (filename), href)
+            self._includes[key] = incname
+        return self._includes[key]
+
+    def load_files (self, filename):
+        """
+        Load the items for a moduleset file and every file it includes.
+        """
+        files = {}
+        todo = [filename]
+        # The pool is only started once some level has more than one miss,
+        # so fully cached modulesets never fork.
+        pool = None
+        try:
+            while len(todo) > 0:
+                misses = []
+                for fname in todo:
+                    content = open (fname).read ()
+                    digest = md5 (content).hexdigest ()
+                    ident = self.get_cache_ident (fname)
+                    cache = blip.db.CacheData.get ((ident, u'jhbuild-moduleset'))
+                    if cache is None:
+                        cache = blip.db.CacheData (ident=ident, key=u'jhbuild-moduleset')
+                    elif (cache.data.get ('format') == self.cache_format and
+                          cache.data.get ('md5') == digest):
+                        files[fname] = cache.data.get ('items', [])
+                        continue
+                    misses.append ((fname, digest, cache, content))
+
+                args = [(self.streaming, content) for fname, digest, cache, content in misses]
+                if self.workers > 1 and len(args) > 1:
+                    if pool is None:
+                        pool = multiprocessing.Pool (self.workers)
+                    results = pool.map (_parse_items, args)
+                else:
+                    results = map (_parse_items, args)
+                for (fname, digest, cache, content), items in zip (misses, results):
+                    blip.utils.log ('Parsed moduleset %s' % os.path.basename (fname))
+                    cache.data['format'] = self.cache_format
+                    cache.data['md5'] = digest
+                    cache.data['items'] = items
+                    files[fname] = items
+
+                nexttodo = []
+                for fname in todo:
+                    for item in files[fname]:
+                        if item[0] != 'include':
+                            continue
+                        incname = self.resolve_include (fname, item[1])
+                        if incname is None or files.has_key (incname) or incname in nexttodo:
+                            continue
+                        nexttodo.append (incname)
+                todo = nexttodo
+        finally:
+            if pool is not None:
+                pool.close ()
+                pool.join ()
+        return files
+
+    @classmethod
+    def get_cache_ident (cls, filename):
+        """Get the CacheData ident for a moduleset file."""
+        filename = os.path.normpath (os.path.abspath (filename))
+        scm_dir = os.path.normpath (os.path.abspath (blinq.config.scm_dir))
+        # Files outside the scm directory, like those in a mirror, are
+        # keyed by their absolute path.
+        if filename.startswith (scm_dir + os.sep):
+            return u'/jhbuild/' + blip.utils.utf8dec (filename[len(scm_dir) + 1:])
+        return u'/jhbuild-file' + blip.utils.utf8dec (filename)
+
+    @classmethod
+    def parse_items_dom (cls, content):
+        """
+        Parse the contents of a moduleset file into a list of items with minidom.
+        """
+        items = []
+        dom = xml.dom.minidom.parseString (content)
         repos = {}
         default_repo = None
         for node in dom.documentElement.childNodes:
@@ -188,7 +566,7 @@ class ModuleSet:
                         if child.hasAttribute ('revision'):
                             pkg_data['scm_branch'] = child.getAttribute ('revision')
                         else:
-                            pkg_data['scm_branch'] = blip.scm.Repository.get_default_branch(pkg_data['scm_type'])
+                            pkg_data['scm_branch'] = get_default_branch (pkg_data['scm_type'])
                     elif child.tagName == 'dependencies':
                         deps = []
                         for dep in child.childNodes:
@@ -196,9 +574,7 @@ class ModuleSet:
                                 deps.append (dep.getAttribute ('package'))
                         pkg_data['deps'] = deps
                 if pkg_data.has_key ('scm_type'):
-                    self._packages[pkg_data['id']] = pkg_data
-                    self._metas.setdefault (base, [])
-                    self._metas[base].append (pkg_data['id'])
+                    items.append (['package', pkg_data])
             elif node.tagName == 'metamodule':
                 meta = []
                 for deps in node.childNodes:
@@ -207,65 +583,219 @@ class ModuleSet:
                             if dep.nodeType == dep.ELEMENT_NODE and dep.tagName == 'dep':
                                 meta.append (dep.getAttribute ('package'))
                         break
-                self._metas[node.getAttribute ('id')] = meta
+                items.append (['metamodule', node.getAttribute ('id'), meta])
             elif node.tagName == 'include':
-                href = node.getAttribute ('href')
-                if not href.startswith ('http:'):
-                    self.parse (os.path.join (os.path.dirname (filename), href))
+                items.append (['include', node.getAttribute ('href')])
+        return items
 
 
-# FIXME
-def __update_deps ():
-    for ident, recdata in records.items():
-        # Records could have package information defined in multiple modulesets.
-        # If the jhbuild maintainers are on the ball, the dependencies in either
-        # should be equivalent, except they might end up pointing to different
-        # branches, as a result of what branches of other modules are included
-        # in the particular moduleset.
-        #
-        # I toyed around with having dependencies go from Branch to Branchable,
-        # which would make this a moot point, but it makes it difficult to do
-        # dependency graphs, because you have to arbitrarily choose branches
-        # of dependencies, and that could affect further dependencies.
-        #
-        # So we arbitrarity take the first moduleset.  It's probably a good
-        # idea to keep newer modulesets first in sets.xml.
-        moduleset, pkgkey = recdata['pkgdatas'][0]
-        rec = recdata['record']
-        pkgdata = moduleset.get_package (pkgkey)
-        deps = get_deps (moduleset, pkgkey)
-        pkgrels = []
-        pkgdrels = []
-        for dep in deps:
-            depdata = moduleset.get_package (dep)
-            if not depdata.has_key ('__record__'): continue
-            deprec = depdata['__record__']
-            rel = pulse.db.ModuleDependency.set_related (rec, deprec)
-            pkgrels.append (rel)
-            direct = (dep in pkgdata['deps'])
-            if rel.direct != direct:
-                rel.direct = direct
-        rec.set_relations (pulse.db.ModuleDependency, pkgrels)
-
-# FIXME
-#known_deps = {}
-def ___get_deps (moduleset, pkg, seen=[]):
-    depskey = moduleset.filename + ':' + pkg
-    if known_deps.has_key (depskey):
-        return known_deps[depskey]
-    pkgdata = moduleset.get_package (pkg)
-    deps = []
-    for dep in pkgdata.get('deps', []):
-        # Prevent infinite loops for circular dependencies
-        if dep in seen: continue
-        if not moduleset.has_package (dep): continue
-        depdata = moduleset.get_package (dep)
-        if not dep in deps:
-            deps.append (dep)
-            for depdep in get_deps (moduleset, dep, seen + [pkg]):
-                if not depdep in deps:
-                    deps.append (depdep)
-    known_deps[depskey] = deps
-    return deps
+    @classmethod
+    def parse_items_stream (cls, content):
+        """
+        Parse the contents of a moduleset file into a list of items with iterparse.
+        """
+        items = []
+        repos = {}
+        default_repo = None
+        root = None
+        pkg_data = None
+        meta = None
+        meta_done = False
+        deps = None
+        depth = 0
+        for event, elem in xml.etree.cElementTree.iterparse (cStringIO.StringIO (content),
+                                                             events=('start', 'end')):
+            if event == 'end':
+                if depth == 2:
+                    if elem.tag == 'autotools':
+                        if pkg_data.has_key ('scm_type'):
+                            items.append (['package', pkg_data])
+                        pkg_data = None
+                    elif elem.tag == 'metamodule':
+                        items.append (['metamodule', _attr (elem, 'id'), meta])
+                        meta = None
+                    root.clear ()
+                elif depth == 3 and elem.tag == 'dependencies':
+                    if deps is not None and meta is not None:
+                        meta_done = True
+                    deps = None
+                depth -= 1
+                continue
+            depth += 1
+            if depth == 1:
+                root = elem
+            elif depth == 2:
+                if elem.tag == 'repository':
+                    repo_data = {}
+                    repo_data['scm_type'] = _attr (elem, 'type')
+                    if repo_data['scm_type'] == 'cvs':
+                        repo_data['scm_server'] = _attr (elem, 'cvsroot')
+                    else:
+                        repo_data['scm_server'] = _attr (elem, 'href')
+                    repo_data['repo_name'] = _attr (elem, 'name')
+                    if elem.get ('name') is not None:
+                        repos[repo_data['repo_name']] = repo_data
+                    if elem.get ('default') == 'yes':
+                        default_repo = repo_data
+                elif elem.tag == 'autotools':
+                    pkg_data = {'id' : _attr (elem, 'id')}
+                    if elem.get ('autogenargs') is not None:
+                        pkg_data['autogenargs'] = _attr (elem, 'autogenargs')
+                elif elem.tag == 'metamodule':
+                    meta = []
+                    meta_done = False
+                elif elem.tag == 'include':
+                    items.append (['include', _attr (elem, 'href')])
+            elif depth == 3 and pkg_data is not None:
+                if elem.tag == 'branch':
+                    if elem.get ('repo') is not None:
+                        repo_data = repos.get (_attr (elem, 'repo'), None)
+                    else:
+                        repo_data = default_repo
+                    if repo_data != None:
+                        pkg_data['scm_type'] = repo_data['scm_type']
+                        pkg_data['scm_server'] = repo_data['scm_server']
+                    pkg_data['scm_module'] = pkg_data['id']
+                    if elem.get ('module') is not None:
+                        pkg_data['scm_path'] = _attr (elem, 'module')
+                    if elem.get ('revision') is not None:
+                        pkg_data['scm_branch'] = _attr (elem, 'revision')
+                    else:
+                        pkg_data['scm_branch'] = get_default_branch (pkg_data['scm_type'])
+                elif elem.tag == 'dependencies':
+                    deps = pkg_data['deps'] = []
+            elif depth == 3 and meta is not None:
+                if elem.tag == 'dependencies' and not meta_done:
+                    deps = meta
+            elif depth == 4 and deps is not None and elem.tag == 'dep':
+                deps.append (_attr (elem, 'package'))
+        return items
+
+
+class DependencyGraph:
+    """
+    Transitive dependencies between the packages in a moduleset.
+    """
+
+    def __init__ (self, moduleset):
+        self._direct = {}
+        for key in moduleset.get_packages ():
+            deps = []
+            for dep in moduleset.get_package (key).get ('deps', []):
+                if moduleset.has_package (dep) and dep not in deps:
+                    deps.append (dep)
+            self._direct[key] = deps
+        self._sccs = strongly_connected_components (sorted (self._direct.keys ()),
+                                                    lambda key: self._direct[key])
+        self._component = {}
+        for i in range (len (self._sccs)):
+            for key in self._sccs[i]:
+                self._component[key] = i
+        self._reach = []
+        for i in range (len (self._sccs)):
+            bits = 0
+            for key in self._sccs[i]:
+                for dep in self._direct[key]:
+                    j = self._component[dep]
+                    if j != i:
+                        bits |= self._reach[j] | (1 << j)
+            self._reach.append (bits)
+
+    def get_cycles (self):
+        """Get the lists of packages that have circular dependencies."""
+        return [scc for scc in self._sccs
+                if len(scc) > 1 or scc[0] in self._direct[scc[0]]]
+
+    def is_direct (self, key, dep):
+        """Check if a package directly depends on another package."""
+        return dep in self._direct.get (key, [])
+
+    def get_deps (self, key):
+        """
+        Get every package a package depends on, directly or indirectly.
+        """
+        i = self._component[key]
+        deps = []
+        # Reversed binary string, so that bit j is at offset j
+        bits = bin (self._reach[i])[:1:-1]
+        j = bits.find ('1')
+        while j >= 0:
+            deps.extend (self._sccs[j])
+            j = bits.find ('1', j + 1)
+        deps.extend ([dep for dep in self._sccs[i] if dep != key])
+        return deps
+
+
+def strongly_connected_components (nodes, successors):
+    """
+    Find the strongly connected components of a directed graph.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    onstack = set ()
+    sccs = []
+    for node in nodes:
+        if index.has_key (node):
+            continue
+        index[node] = lowlink[node] = len(index)
+        stack.append (node)
+        onstack.add (node)
+        work = [(node, iter (successors (node)))]
+        while len(work) > 0:
+            v, children = work[-1]
+            for w in children:
+                if not index.has_key (w):
+                    index[w] = lowlink[w] = len(index)
+                    stack.append (w)
+                    onstack.add (w)
+                    work.append ((w, iter (successors (w))))
+                    break
+                elif w in onstack:
+                    lowlink[v] = min (lowlink[v], index[w])
+            else:
+                work.pop ()
+                if len(work) > 0:
+                    u = work[-1][0]
+                    lowlink[u] = min (lowlink[u], lowlink[v])
+                if lowlink[v] == index[v]:
+                    scc = []
+                    while True:
+                        w = stack.pop ()
+                        onstack.discard (w)
+                        scc.append (w)
+                        if w == v:
+                            break
+                    sccs.append (scc)
+    return sccs
+
+
+def get_package_digest (pkg_data):
+    """
+    Get an MD5 digest of the parsed data for a package.
+    """
+    items = [(key, pkg_data[key]) for key in sorted (pkg_data.keys ())
+             if not key.startswith ('__')]
+    return md5 (repr (items)).hexdigest ()
+
+
+_default_branches = {}
+def get_default_branch (scm_type):
+    if not _default_branches.has_key (scm_type):
+        _default_branches[scm_type] = blip.scm.Repository.get_default_branch (scm_type)
+    return _default_branches[scm_type]
+
+
+def _parse_items (args):
+    # Module-level so it can be sent to worker processes
+    streaming, content = args
+    if streaming:
+        return ModuleSet.parse_items_stream (content)
+    else:
+        return ModuleSet.parse_items_dom (content)
 
 
+def _attr (elem, name):
+    # minidom always gives us unicode and empty strings for missing
+    # attributes, and the cached items should look the same either way.
+    return unicode (elem.get (name, u''))